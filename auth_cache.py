@@ -0,0 +1,41 @@
+import time
+from collections import namedtuple
+
+Principal = namedtuple('Principal', ['id', 'username', 'email', 'is_admin', 'token_version'])
+
+class PrincipalCache:
+    """Authenticated users by token subject, so authorizing a request does not need the users table.
+
+    Entries live for ttl seconds. Tokens carry the user's token_version, bumping it in the
+    database and calling revoke() rejects every token issued before.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        entry = self.entries.get(username)
+        if entry is None:
+            self.misses += 1
+            return None
+        principal, expires = entry
+        if expires < time.monotonic():
+            self.entries.pop(username, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return principal
+
+    def put(self, user):
+        principal = Principal(user.id, user.username, user.email, user.is_admin, user.token_version or 0)
+        self.entries[user.username] = (principal, time.monotonic() + self.ttl)
+        return principal
+
+    def revoke(self, username):
+        self.entries.pop(username, None)
+
+    def clear(self):
+        self.entries.clear()
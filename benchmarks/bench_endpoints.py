@@ -0,0 +1,213 @@
+"""Load and latency benchmark for the API endpoints.
+
+Usage:
+    python benchmarks/bench_endpoints.py --rows 77 10000 --requests 300 --concurrency 8
+    python benchmarks/bench_endpoints.py --rows 10000 --catalog --json after.json --compare before.json
+    python benchmarks/bench_endpoints.py --server http://localhost:8000 --scenarios list by_id
+
+The app runs in process (no network) against a temporary SQLite database seeded with a
+synthetic catalog, unless --server is given. Needs aiosqlite and httpx. Request parameters
+come from a fixed seed and every scenario is warmed up first, so runs with the same
+arguments can be compared. Scenarios that write run last.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import httpx
+
+from synthetic import ROOT, seed_sqlite, percentile
+from pagination import encode_cursor
+
+ADMIN = {"username": "admin", "password": "admin"}
+PICTURE_IDS = 77
+
+# name: (method, path, json body or None, needs admin token), built from a seeded random generator
+SCENARIOS = {
+    "list": lambda rng, rows: ("GET", "/cereals?limit=100", None, False),
+    "list_cursor": lambda rng, rows: ("GET", f"/cereals?limit=100&cursor={page_after(rng.randint(0, max(rows - 100, 0)))}", None, False),
+    "filter": lambda rng, rows: ("POST", "/cereals/filter?limit=100", {"filters": {"calories": ["lt", rng.choice([90, 100, 110])], "sugars": ["lt", rng.randint(3, 12)]}, "order": "asc"}, False),
+    "field": lambda rng, rows: ("GET", f"/cereals/mfr/{rng.choice('GKNPQR')}?limit=100", None, False),
+    "sorted": lambda rng, rows: ("GET", f"/cereals/sorted/{rng.choice(['rating', 'calories', 'sugars'])}?order=desc&limit=100", None, False),
+    "by_id": lambda rng, rows: ("GET", f"/cereals/{rng.randint(1, rows)}", None, False),
+    "search": lambda rng, rows: ("GET", f"/cereals/search?q={rng.choice(['chee', 'bran', 'frost', 'honey', 'cherios'])}", None, False),
+    "stats": lambda rng, rows: ("GET", f"/cereals/stats?group_by={rng.choice(['mfr', 'type', 'shelf'])}", None, False),
+    "picture_base64": lambda rng, rows: ("GET", f"/cereals/{rng.randint(1, min(rows, PICTURE_IDS))}/picture?response_type=base64", None, False),
+    "picture_file": lambda rng, rows: ("GET", f"/cereals/{rng.randint(1, min(rows, PICTURE_IDS))}/picture?response_type=file", None, False),
+    "login": lambda rng, rows: ("POST", "/token", None, False),
+    "admin_write": lambda rng, rows: ("POST", f"/cereals?id={rng.randint(1, min(rows, PICTURE_IDS))}", None, True),
+}
+WRITE_SCENARIOS = ("admin_write",)
+
+def page_after(id):
+    return encode_cursor('id', 'asc', SimpleNamespace(id=id))
+
+def prepare_workdir(workdir, url, catalog_mode):
+    # main.py reads its settings and pictures relative to the working directory
+    with open(os.path.join(workdir, 'db_info.json'), 'w') as f:
+        json.dump({"url": url, "connect_args": {}, "catalog_mode": catalog_mode, "startup_mode": "auto"}, f)
+    with open(os.path.join(workdir, 'jwt_info.json'), 'w') as f:
+        json.dump({"secret_key": secrets.token_hex(32), "algorithm": "HS256", "access_token_expire_minutes": 60}, f)
+    for name in ('Cereal Pictures', 'Cereal.csv'):
+        try:
+            os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+        except OSError:
+            copy = shutil.copytree if os.path.isdir(os.path.join(ROOT, name)) else shutil.copy
+            copy(os.path.join(ROOT, name), os.path.join(workdir, name))
+
+async def login(client):
+    response = await client.post("/token", data=ADMIN)
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+async def run_scenario(client, name, rows, requests, concurrency, headers, bodies):
+    build = SCENARIOS[name]
+    warmup = max(1, min(20, requests // 10))
+
+    def request(index):
+        # Same seed, same requests, independent of scheduling
+        method, path, body, admin = build(random.Random(f"{name}:{index}"), rows)
+        kwargs = {"headers": headers if admin else {}}
+        if name == "login":
+            kwargs["data"] = ADMIN
+        elif name == "admin_write":
+            kwargs["json"] = bodies[int(path.rsplit('=', 1)[1])]
+        elif body is not None:
+            kwargs["json"] = body
+        return client.request(method, path, **kwargs)
+
+    for index in range(warmup):
+        await request(-1 - index)
+
+    samples, statuses = [], {}
+    queue = asyncio.Queue()
+    for index in range(requests):
+        queue.put_nowait(index)
+
+    async def worker():
+        while not queue.empty():
+            index = queue.get_nowait()
+            start = time.perf_counter()
+            response = await request(index)
+            await response.aread()
+            samples.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    errors = sum(count for status, count in statuses.items() if status >= 400)
+    return {
+        "scenario": name,
+        "requests": requests,
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+        "errors": errors,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+async def run_client(client, rows, args):
+    headers = await login(client)
+    # Writes send each cereal's current values back, so the data stays the same between runs
+    bodies = {}
+    for id in range(1, min(rows, PICTURE_IDS) + 1):
+        response = await client.get(f"/cereals/{id}")
+        if response.status_code == 200:
+            bodies[id] = {key: value for key, value in response.json().items() if key != 'id'}
+    names = [name for name in args.scenarios if name not in WRITE_SCENARIOS] + [name for name in args.scenarios if name in WRITE_SCENARIOS]
+    results = []
+    for name in names:
+        # Hashing is deliberately slow, so login gets fewer requests
+        requests = max(1, args.requests // 10) if name == "login" else args.requests
+        results.append(await run_scenario(client, name, rows, requests, args.concurrency, headers, bodies))
+    return results
+
+async def run_in_process(rows, args):
+    with tempfile.TemporaryDirectory() as workdir:
+        start = time.perf_counter()
+        url = seed_sqlite(os.path.join(workdir, 'cereals.db'), rows)
+        prepare_workdir(workdir, url, args.catalog)
+        seed_time = time.perf_counter() - start
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            import main
+            start = time.perf_counter()
+            async with main.app.router.lifespan_context(main.app):
+                startup_time = time.perf_counter() - start
+                transport = httpx.ASGITransport(app=main.app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                    results = await run_client(client, rows, args)
+        finally:
+            os.chdir(cwd)
+    return {"seed_s": round(seed_time, 3), "startup_s": round(startup_time, 3)}, results
+
+def print_results(title, results, previous=None):
+    print(f"\n{title}")
+    print(f"{'scenario':16} {'reqs':>6} {'rps':>9} {'p50':>10} {'p99':>10} {'errors':>7}" + (f" {'p50 vs prev':>12} {'rps vs prev':>12}" if previous else ""))
+    for result in results:
+        line = (f"{result['scenario']:16} {result['requests']:>6} {result['rps']:>9.1f} "
+                f"{result['p50_ms']:>8.2f}ms {result['p99_ms']:>8.2f}ms {result['errors']:>7}")
+        before = (previous or {}).get(result['scenario'])
+        if before:
+            line += f" {result['p50_ms'] / before['p50_ms']:>11.2f}x {result['rps'] / before['rps']:>11.2f}x"
+        print(line)
+
+def load_previous(path):
+    # Results by (rows, scenario) from an earlier --json file
+    with open(path) as f:
+        data = json.load(f)
+    print(f"Comparing with {path} {data['settings']}")
+    return {str(run["rows"]): {result["scenario"]: result for result in run["results"]} for run in data["runs"]}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[77, 10000], help="Catalog sizes, e.g. 77 10000 1000000")
+    parser.add_argument('--requests', type=int, default=300, help="Requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent clients")
+    parser.add_argument('--catalog', action='store_true', help="Run with catalog_mode on")
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--server', help="Benchmark a running server instead, its catalog size is taken from --rows")
+    parser.add_argument('--json', help="Write the results to this file")
+    parser.add_argument('--compare', help="Results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    previous = load_previous(args.compare) if args.compare else {}
+    settings = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "catalog": args.catalog if not args.server else None,
+        "server": args.server,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+    runs = []
+    for rows in args.rows:
+        if args.server:
+            async def remote():
+                async with httpx.AsyncClient(base_url=args.server, timeout=60) as client:
+                    return await run_client(client, rows, args)
+            timings, results = {}, asyncio.run(remote())
+        else:
+            timings, results = asyncio.run(run_in_process(rows, args))
+            # A fresh app for the next size
+            sys.modules.pop('main', None)
+        print_results(f"{rows} rows {timings}", results, previous.get(str(rows)))
+        runs.append({"rows": rows, **timings, "results": results})
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"settings": settings, "runs": runs}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Compare the SQL and columnar catalog paths of Cereal.get_by_filters / get_by_field_value.
+
+Usage:
+    python benchmarks/bench_filters.py --rows 77 10000 200000 --repeat 20
+
+Runs against a temporary SQLite database (needs aiosqlite) unless --url is given.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from synthetic import seed_sqlite, percentile
+from db_classes import Cereal
+from db_catalog import Catalog
+from db_connect import DatabaseConnect
+
+QUERIES = [
+    ("filter calories<100 sodium<200", 'get_by_filters', ({"calories": ["lt", 100], "sodium": ["lt", 200]}, 'asc')),
+    ("filter mfr=K rating>=40 desc", 'get_by_filters', ({"mfr": ["eq", "K"], "rating": ["gte", 40]}, 'desc')),
+    ("field sugars>10", 'get_by_field_value', ('sugars', '10', 'gt', 'asc')),
+    ("field name!=Trix desc", 'get_by_field_value', ('name', 'Trix', 'ne', 'desc')),
+    ("sorted rating desc", 'get_by_field_sorted', ('rating', 'desc')),
+]
+
+async def time_query(session, method, args, repeat):
+    samples = []
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = await getattr(Cereal, method)(session, *args)
+        samples.append(time.perf_counter() - start)
+        count = len(result)
+    return samples, count
+
+async def run(url, rows, repeat, connect_args):
+    db = DatabaseConnect(url, connect_args=connect_args)
+    catalog = Catalog(Cereal)
+    async with await db.get_new_session() as session:
+        start = time.perf_counter()
+        await catalog.load(session)
+        load_time = time.perf_counter() - start
+        print(f"\n{rows} rows (catalog load {load_time * 1000:.1f} ms)")
+        print(f"{'query':34} {'matches':>8} {'sql p50':>10} {'sql p99':>10} {'col p50':>10} {'col p99':>10} {'speedup':>8}")
+        for label, method, args in QUERIES:
+            Cereal.catalog = None
+            sql_samples, _ = await time_query(session, method, args, repeat)
+            Cereal.catalog = catalog
+            col_samples, count = await time_query(session, method, args, repeat)
+            Cereal.catalog = None
+            sql_p50, col_p50 = percentile(sql_samples, 50), percentile(col_samples, 50)
+            print(f"{label:34} {count:>8} {sql_p50 * 1000:>8.2f}ms {percentile(sql_samples, 99) * 1000:>8.2f}ms "
+                  f"{col_p50 * 1000:>8.2f}ms {percentile(col_samples, 99) * 1000:>8.2f}ms {sql_p50 / col_p50:>7.1f}x")
+    await db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[77, 10000, 200000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--url', help="Existing database URL to benchmark instead of a seeded SQLite file")
+    args = parser.parse_args()
+    if args.url:
+        asyncio.run(run(args.url, 'existing', args.repeat, {'connect_timeout': 5}))
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.rows:
+            url = seed_sqlite(os.path.join(tmp, f"cereals_{rows}.db"), rows)
+            asyncio.run(run(url, rows, args.repeat, {}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Benchmark SimilarityIndex: load time, nearest neighbour queries and in-place updates.
+
+Usage:
+    python benchmarks/bench_similar.py --rows 77 10000 200000 1000000 --repeat 50
+
+Runs against a temporary SQLite database (needs aiosqlite).
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from collections import namedtuple
+
+from synthetic import seed_sqlite, synthetic_cereals, percentile
+from db_classes import Cereal
+from db_connect import DatabaseConnect
+from similarity import SimilarityIndex, NUTRITION_FIELDS
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+async def run(url, rows, repeat, k, batch_size):
+    db = DatabaseConnect(url, connect_args={})
+    index = SimilarityIndex(Cereal, batch_size=batch_size)
+    async with await db.get_new_session() as session:
+        start = time.perf_counter()
+        await index.load(session)
+        load_time = time.perf_counter() - start
+    await db.close()
+
+    rng = random.Random(42)
+    ids = [rng.randint(1, rows) for _ in range(repeat)]
+    query = [timed(index.nearest, id, k, NUTRITION_FIELDS) for id in ids]
+    # Updates write a row back with changed values, inserts and deletes add and remove new ids
+    Row = namedtuple('Row', ['id', *index.fields])
+    samples = list(synthetic_cereals(repeat))
+    updates = [timed(index.put_many, [Row(ids[i], *(samples[i][field] + 1 for field in index.fields))]) for i in range(repeat)]
+    inserts = [timed(index.put_many, [Row(rows + 1 + i, *(samples[i][field] for field in index.fields))]) for i in range(repeat)]
+    deletes = [timed(index.remove_many, [rows + 1 + i]) for i in range(repeat)]
+
+    print(f"\n{rows} rows (load {load_time * 1000:.1f} ms, k={k}, batch {batch_size})")
+    print(f"{'operation':12} {'p50':>10} {'p99':>10}")
+    for label, values in (("nearest", query), ("update", updates), ("insert", inserts), ("delete", deletes)):
+        print(f"{label:12} {percentile(values, 50) * 1000:>8.3f}ms {percentile(values, 99) * 1000:>8.3f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[77, 10000, 200000])
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=65536)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.rows:
+            url = seed_sqlite(os.path.join(tmp, f"cereals_{rows}.db"), rows)
+            asyncio.run(run(url, rows, args.repeat, args.k, args.batch_size))
+
+if __name__ == "__main__":
+    main()
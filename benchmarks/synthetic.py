@@ -0,0 +1,53 @@
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from db_setup import read_cereals
+
+def synthetic_cereals(count, seed=42):
+    """Yield count cereal rows based on Cereal.csv with jittered values and unique names."""
+    rng = random.Random(seed)
+    base = read_cereals(os.path.join(ROOT, 'Cereal.csv'))
+    for i in range(count):
+        row = dict(base[i % len(base)])
+        if i >= len(base):
+            row['name'] = f"{row['name'][:40]} #{i}"
+            for field in ('calories', 'sodium', 'potass'):
+                row[field] = max(0, row[field] + rng.randint(-10, 10))
+            for field in ('protein', 'fat', 'sugars'):
+                row[field] = max(0, row[field] + rng.randint(-1, 1))
+            row['rating'] = round(max(0.0, row['rating'] + rng.uniform(-5, 5)), 2)
+            row['shelf'] = rng.randint(1, 3)
+        row['id'] = i + 1
+        yield row
+
+def seed_sqlite(path, count, batch_size=10000):
+    """Create a SQLite database at path with count synthetic cereals, returns the async URL."""
+    from sqlalchemy import create_engine
+    from db_classes import Base, Cereal
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    batch = []
+    with engine.begin() as conn:
+        for row in synthetic_cereals(count):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                conn.execute(Cereal.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(Cereal.__table__.insert(), batch)
+    engine.dispose()
+    return f"sqlite+aiosqlite:///{path}"
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
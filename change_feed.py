@@ -0,0 +1,91 @@
+import asyncio
+import json
+import secrets
+
+class ChangeFeed:
+    """Recent inserts, updates and deletes of a model as server-sent events.
+
+    Each change gets the next version and is encoded once into a fixed size ring shared by
+    all listeners. A listener only holds the version it has sent up to, so an idle one costs
+    a waiting coroutine. A listener that falls more than the ring size behind, or resumes
+    from an id this process did not hand out, gets a reset event and should reload the list.
+    """
+
+    def __init__(self, model, history=1000, batch_size=100, keepalive_seconds=15):
+        self.model = model
+        self.history = history
+        self.batch_size = batch_size
+        self.keepalive_seconds = keepalive_seconds
+        # Event ids are "<epoch>-<version>", a new epoch per process so ids from a restarted
+        # or another worker process are not mistaken for ours
+        self.epoch = secrets.token_hex(4)
+        self.version = 0
+        self.events = [None] * history
+        self.changed = asyncio.Event()
+        self.listeners = 0
+
+    def event_id(self, version):
+        return f"{self.epoch}-{version}"
+
+    def encode(self, version, type, data):
+        data = json.dumps(data, separators=(",", ":"), default=str)
+        return f"id: {self.event_id(version)}\nevent: {type}\ndata: {data}\n\n".encode("utf-8")
+
+    def append(self, type, data):
+        self.version += 1
+        self.events[self.version % self.history] = self.encode(self.version, type, data)
+
+    def row_data(self, row):
+        return {column.name: getattr(row, column.name, None) for column in self.model.__table__.columns}
+
+    def publish(self, rows=(), removed=(), created=()):
+        for row in rows:
+            self.append("insert" if row.id in created else "update", self.row_data(row))
+        for id in removed:
+            self.append("delete", {"id": id})
+        self.wake()
+
+    def publish_reset(self):
+        # The data changed in a way this process did not see, e.g. a write by another worker
+        self.append("reset", {})
+        self.wake()
+
+    def wake(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def parse_event_id(self, event_id):
+        epoch, _, version = (event_id or "").partition("-")
+        if epoch != self.epoch or not version.isdigit() or int(version) > self.version:
+            return None
+        return int(version)
+
+    def pending(self, version):
+        # Encoded events after version, at most batch_size of them
+        stop = min(self.version, version + self.batch_size)
+        return stop, b"".join(self.events[v % self.history] for v in range(version + 1, stop + 1))
+
+    async def stream(self, last_event_id=None):
+        """Yield encoded events from after last_event_id, or from now on without one."""
+        self.listeners += 1
+        try:
+            version = self.parse_event_id(last_event_id)
+            if version is None:
+                # Tells a new listener where it starts, and an unknown one to reload
+                version = self.version
+                yield self.encode(version, "ready" if last_event_id is None else "reset", {})
+            while True:
+                if version < self.version - self.history:
+                    version = self.version
+                    yield self.encode(version, "reset", {})
+                elif version < self.version:
+                    version, chunk = self.pending(version)
+                    yield chunk
+                else:
+                    try:
+                        await asyncio.wait_for(self.changed.wait(), self.keepalive_seconds)
+                    except asyncio.TimeoutError:
+                        # Keeps proxies from closing the connection and finds dead clients
+                        yield b": keepalive\n\n"
+        finally:
+            self.listeners -= 1
@@ -0,0 +1,49 @@
+import io
+import csv
+import codecs
+from pydantic import ValidationError
+from db_pydantic_classes import CerealBase, CerealBatchItem
+from db_setup import clean_rating
+
+EXPORT_FIELDS = list(CerealBase.__fields__)
+
+class CerealCsvReader:
+    """Reads cereal rows from a binary CSV file a chunk at a time.
+
+    Blocking, meant to be called through asyncio.to_thread. Accepts the Cereal.csv layout,
+    including its second line of column types.
+    """
+
+    def __init__(self, binary_file, delimiter=';'):
+        # Not io.TextIOWrapper, it needs readable(), which SpooledTemporaryFile only has from Python 3.11
+        self.text = codecs.getreader('utf-8-sig')(binary_file)
+        self.reader = csv.DictReader(self.text, delimiter=delimiter)
+
+    def read_chunk(self, size):
+        # Returns up to size (line number, item or None, error or None) tuples
+        rows = []
+        for row in self.reader:
+            if self.reader.line_num == 2 and row.get('name') == 'String':
+                continue
+            row.pop(None, None)
+            if not row.get('id'):
+                row.pop('id', None)
+            try:
+                if row.get('rating'):
+                    row['rating'] = clean_rating(row['rating'])
+                rows.append((self.reader.line_num, CerealBatchItem(**row).dict(), None))
+            except (ValidationError, ValueError) as e:
+                rows.append((self.reader.line_num, None, str(e).replace('\n', ' ')))
+            if len(rows) >= size:
+                break
+        return rows
+
+def csv_lines(rows, delimiter=';'):
+    # Returns a batch of row tuples as one block of CSV text
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter, lineterminator='\n')
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+def csv_header(fields, delimiter=';'):
+    return delimiter.join(fields) + '\n'
@@ -0,0 +1,113 @@
+from collections import namedtuple
+from types import MappingProxyType
+from sqlalchemy import String, Enum
+from sqlalchemy.future import select
+from fastapi import HTTPException
+from db_columns import ColumnarTable
+
+class CatalogSnapshot:
+    __slots__ = ('version', 'rows', 'by_id', 'columnar')
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.rows = tuple(sorted(rows, key=lambda row: row.id))
+        self.by_id = MappingProxyType({row.id: row for row in self.rows})
+        # Built on first filtered or sorted read
+        self.columnar = None
+
+class Catalog:
+    """Immutable in-process copy of a table, swapped as a whole on every write."""
+
+    def __init__(self, model):
+        self.model = model
+        self.columns = {column.name: column for column in model.__table__.columns}
+        self.text_columns = {name for name, column in self.columns.items() if isinstance(column.type, (String, Enum))}
+        self.row_class = namedtuple(f"{model.__name__}Row", list(self.columns))
+        self.snapshot = CatalogSnapshot(0, ())
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    def to_row(self, obj):
+        return self.row_class(*(getattr(obj, name) for name in self.columns))
+
+    def swap(self, rows):
+        # Assigning the attribute is atomic, readers see either the old or the new snapshot
+        self.snapshot = CatalogSnapshot(self.snapshot.version + 1, rows)
+        return self.snapshot
+
+    async def load(self, session):
+        # Plain column tuples, building ORM instances would dominate load time on large tables
+        table = self.model.__table__
+        result = await session.execute(select(*(table.c[name] for name in self.columns)))
+        snapshot = self.swap([self.row_class(*row) for row in result])
+        self.get_columnar(snapshot)
+        return snapshot
+
+    def put(self, obj):
+        return self.put_many([obj])
+
+    def put_many(self, objs):
+        rows = dict(self.snapshot.by_id)
+        for obj in objs:
+            row = self.to_row(obj)
+            rows[row.id] = row
+        return self.swap(rows.values())
+
+    def remove(self, id):
+        return self.remove_many([id])
+
+    def remove_many(self, ids):
+        rows = dict(self.snapshot.by_id)
+        for id in ids:
+            rows.pop(id, None)
+        return self.swap(rows.values())
+
+    def coerce(self, field, value):
+        # Mirror MySQL: case-insensitive text, numeric comparison for number columns
+        if field in self.text_columns:
+            return str(value).casefold()
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail=f"Invalid value for {field}: {value}")
+
+    def check_field(self, field):
+        if field not in self.columns:
+            raise HTTPException(status_code=400, detail=f"Invalid field: {field}")
+
+    def get_columnar(self, snapshot):
+        if snapshot.columnar is None:
+            snapshot.columnar = ColumnarTable(snapshot.rows, self.row_class._fields, self.text_columns)
+        return snapshot.columnar
+
+    def get_all(self, after=None, limit=None):
+        if after is None and limit is None:
+            return list(self.snapshot.rows)
+        return self.get_filtered([], None, 'asc', after, limit)
+
+    def get_by_id(self, id):
+        return self.snapshot.by_id.get(id)
+
+    def get_sorted(self, field, order='asc', after=None, limit=None):
+        self.check_field(field)
+        if after is not None or limit is not None:
+            return self.get_filtered([], field, order, after, limit)
+        return self.get_columnar(self.snapshot).sort(field, order == 'desc')
+
+    def get_filtered(self, conditions, order_field=None, order='asc', after=None, limit=None):
+        # conditions is a list of (field, comparison, value), after is the (value, id) keyset cursor
+        coerced = []
+        for field, comparison, value in conditions:
+            self.check_field(field)
+            coerced.append((field, comparison, self.coerce(field, value)))
+        if order_field is not None:
+            self.check_field(order_field)
+        if after is not None:
+            value, last_id = after
+            after = (self.coerce(order_field or 'id', value), self.coerce('id', last_id))
+        return self.get_columnar(self.snapshot).select(coerced, order_field, order == 'desc', after, limit)
+
+    def get_stats(self, group_by, metrics, bins=10):
+        return self.get_columnar(self.snapshot).aggregate(group_by, metrics, bins)
@@ -1,13 +1,18 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Text, Enum, desc, delete, update, inspect, and_
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Text, Enum, desc, delete, insert, update, inspect, and_, or_, cast
 from sqlalchemy.orm import declarative_base, validates
 from sqlalchemy.exc import SQLAlchemyError, NoResultFound, IntegrityError
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
 from datetime import datetime
 import re
 from sqlalchemy.future import select
 from fastapi import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from functools import wraps
+from contextlib import contextmanager
+import time
+from password_hashing import password_hasher
+from db_columns import ColumnarTable
+from pagination import page, peek_limit
 
 def error_handler(func):
     @wraps(func)
@@ -25,22 +30,78 @@ def error_handler(func):
             raise HTTPException(status_code=500, detail=str(e))
     return wrapper
 
+# The key of a duplicate entry in the driver's message, the values in it may contain anything
+UNIQUE_KEY_PATTERNS = (
+    re.compile(r"for key '(?:\w+\.)?(\w+)'"),  # MySQL: Duplicate entry '...' for key 'users.email'
+    re.compile(r"UNIQUE constraint failed: \w+\.(\w+)"),  # SQLite
+)
+
+def violated_unique_key(error):
+    message = str(error.orig)
+    for pattern in UNIQUE_KEY_PATTERNS:
+        # The key comes after the value, so the last match is the real one
+        keys = pattern.findall(message)
+        if keys:
+            return keys[-1].lower()
+    return None
+
+async def prepend(first, rows):
+    yield first
+    async for row in rows:
+        yield row
+
 Base = declarative_base()
 
 class BaseModel(Base):
     __abstract__ = True
+    # Optional db_catalog.Catalog, when set reads are answered from its snapshot
+    catalog = None
+    # Optional name_search.NameIndex, needed by search
+    name_index = None
+    # Optional similarity.SimilarityIndex, needed by similar
+    similarity_index = None
+    # Optional change_feed.ChangeFeed, told about every committed write
+    change_feed = None
+    # Optional index_advisor.QueryShapeRecorder, when set filter and sort shapes are recorded
+    query_shapes = None
+    # Optional callable, told about committed writes, e.g. to signal other worker processes
+    write_listener = None
+    # Changes with every committed write, and when another worker's writes are loaded,
+    # so caches of encoded responses know when they are stale
+    write_version = 0
 
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
-            if value is None and not self.__table__.c[key].nullable:
-                raise ValueError(f"{key} cannot be null")
-            if isinstance(self.__table__.c[key].type, String) and self.__table__.c[key].type.length is not None and len(value) > self.__table__.c[key].type.length:
-                raise SQLAlchemyError(f"{key} must be less than {self.__table__.c[key].type.length} characters")
+            self.check_value(key, value)
             setattr(self, key, value)
 
+    @classmethod
+    def check_value(cls, key, value):
+        if value is None and not cls.__table__.c[key].nullable:
+            raise ValueError(f"{key} cannot be null")
+        if isinstance(cls.__table__.c[key].type, String) and cls.__table__.c[key].type.length is not None and len(value) > cls.__table__.c[key].type.length:
+            raise SQLAlchemyError(f"{key} must be less than {cls.__table__.c[key].type.length} characters")
+
     def __repr__(self):
         return str({column.name: getattr(self, column.name) for column in self.__table__.columns if hasattr(self, column.name)})
 
+    @classmethod
+    def after_write(cls, rows=(), removed=(), created=()):
+        # Keep the in-process copies in step with a committed write, created holds the new ids among rows
+        for index in (cls.catalog, cls.name_index, cls.similarity_index):
+            if index is None:
+                continue
+            if rows:
+                index.put_many(rows)
+            if removed:
+                index.remove_many(removed)
+        if rows or removed:
+            cls.write_version += 1
+        if cls.change_feed is not None:
+            cls.change_feed.publish(rows, removed, created)
+        if cls.write_listener is not None and (rows or removed):
+            cls.write_listener()
+
     @classmethod
     @error_handler
     async def add(cls, session, **kwargs):
@@ -48,33 +109,45 @@ class BaseModel(Base):
         row = cls(**kwargs)
         session.add(row)
         await session.commit()
+        cls.after_write(rows=[row], created={row.id})
         return row
 
     @classmethod
     @error_handler
     async def update(cls, session, id, **kwargs):
-        # Check if a row with the given id exists
-        existing_row = (await session.execute(select(cls).where(cls.id == id))).scalar_one_or_none()
-        if not existing_row:
-            raise HTTPException(status_code=404, detail=f"No {cls.__name__} found with id {id}")
-
-        # Update existing row
-        stmt = update(cls).where(cls.id == id).values(**kwargs)
-        await session.execute(stmt)
+        # rowcount tells whether the row exists, MySQL reports matched rather than changed rows
+        result = await session.execute(update(cls).where(cls.id == id).values(**kwargs).execution_options(synchronize_session=False))
         await session.commit()
+        if result.rowcount == 0:
+            raise HTTPException(status_code=404, detail=f"No {cls.__name__} found with id {id}")
 
-        # Refresh the row to get the updated instance
-        row = (await session.execute(select(cls).where(cls.id == id))).scalar_one_or_none()
+        if cls.is_complete(kwargs):
+            # Every column was just written, so the row does not need to be read back
+            row = cls(**kwargs)
+            row.id = id
+        else:
+            row = (await session.execute(select(cls).where(cls.id == id))).scalar_one_or_none()
+        if row is not None:
+            cls.after_write(rows=[row])
         return row
 
+    @classmethod
+    def is_complete(cls, values):
+        for column in cls.__table__.columns:
+            if column.primary_key:
+                continue
+            if column.name not in values or column.onupdate is not None or column.server_onupdate is not None:
+                return False
+        return True
+
     @classmethod
     @error_handler
     async def delete(cls, session, id):
-        row = (await session.execute(select(cls).where(cls.id == id))).scalar_one_or_none()
-        if row is None:
-            raise HTTPException(status_code=404, detail=f"No {cls.__name__} found with id {id}")
-        await session.delete(row)
+        result = await session.execute(delete(cls).where(cls.id == id).execution_options(synchronize_session=False))
         await session.commit()
+        if result.rowcount == 0:
+            raise HTTPException(status_code=404, detail=f"No {cls.__name__} found with id {id}")
+        cls.after_write(removed=[id])
 
     @classmethod
     @error_handler
@@ -84,6 +157,119 @@ class BaseModel(Base):
         else:
             return await cls.add(session, **kwargs)
         
+    @classmethod
+    @error_handler
+    async def bulk_upsert(cls, session, items):
+        """Insert or update many rows in one transaction with a fixed number of statements.
+
+        Items with an id update that row. Items without an id update the row with the same
+        unique key (e.g. Cereal.name) or are inserted. Returns one result per item.
+        """
+        key = next((column.name for column in cls.__table__.columns if column.unique), None)
+        normalize = lambda value: value.casefold() if isinstance(value, str) else value
+
+        # 1 statement: which of the given ids and keys already exist
+        ids = [item['id'] for item in items if item.get('id') is not None]
+        # Keys of updates too, a row renamed to a key another row has would break the batch
+        keys = [item[key] for item in items if key and item.get(key) is not None]
+        conditions = []
+        if ids:
+            conditions.append(cls.id.in_(ids))
+        if keys:
+            conditions.append(getattr(cls, key).in_(keys))
+        existing_ids = set()
+        id_by_key = {}
+        if conditions:
+            columns = [cls.id, getattr(cls, key)] if key else [cls.id]
+            for row in await session.execute(select(*columns).where(or_(*conditions))):
+                existing_ids.add(row[0])
+                if key:
+                    id_by_key[normalize(row[1])] = row[0]
+
+        results = []
+        inserts = []
+        updates = []
+        created = []
+        seen = set()
+        claimed = set()
+        for index, item in enumerate(items):
+            values = {name: value for name, value in item.items() if name != 'id'}
+            try:
+                for name, value in values.items():
+                    cls.check_value(name, value)
+            except (ValueError, SQLAlchemyError) as e:
+                results.append({"index": index, "id": item.get('id'), "status": "error", "detail": str(e)})
+                continue
+            row_id = item.get('id')
+            if row_id is not None and row_id not in existing_ids:
+                results.append({"index": index, "id": row_id, "status": "not_found", "detail": f"No {cls.__name__} found with id {row_id}"})
+                continue
+            key_value = normalize(values.get(key)) if key else None
+            if row_id is None and key:
+                row_id = id_by_key.get(key_value)
+            marker = ('id', row_id) if row_id is not None else ('key', key_value)
+            if marker in seen or (key_value is not None and key_value in claimed):
+                results.append({"index": index, "id": row_id, "status": "error", "detail": "Duplicate item in batch"})
+                continue
+            owner = id_by_key.get(key_value) if key_value is not None else None
+            if owner is not None and owner != row_id:
+                results.append({"index": index, "id": row_id, "status": "error", "detail": f"A {cls.__name__} with {key} {values[key]!r} already exists (id {owner})"})
+                continue
+            seen.add(marker)
+            if key_value is not None:
+                claimed.add(key_value)
+            if row_id is not None:
+                updates.append({"id": row_id, **values})
+                results.append({"index": index, "id": row_id, "status": "updated", "detail": None})
+            else:
+                inserts.append(values)
+                results.append({"index": index, "id": None, "status": "created", "detail": None})
+                created.append((results[-1], values.get(key)))
+
+        # 1 executemany each for updates and inserts
+        if updates:
+            await session.execute(update(cls), updates)
+        if inserts:
+            await session.execute(insert(cls), inserts)
+
+        # 1 statement: read back the affected rows for new ids and the catalog
+        conditions = []
+        if updates:
+            conditions.append(cls.id.in_([values['id'] for values in updates]))
+        if inserts and key:
+            conditions.append(getattr(cls, key).in_([values[key] for values in inserts]))
+        rows = (await session.execute(select(cls).where(or_(*conditions)))).scalars().all() if conditions else []
+        await session.commit()
+
+        if key:
+            id_by_key = {normalize(getattr(row, key)): row.id for row in rows}
+            for result, key_value in created:
+                result["id"] = id_by_key.get(normalize(key_value))
+        cls.after_write(rows=rows, created={result["id"] for result, key_value in created})
+        return results
+
+    @classmethod
+    @error_handler
+    async def bulk_delete(cls, session, ids):
+        # One result per position in ids, a repeated id is an error like in bulk_upsert
+        unique_ids = list(dict.fromkeys(ids))
+        existing = set((await session.execute(select(cls.id).where(cls.id.in_(unique_ids)))).scalars().all()) if unique_ids else set()
+        if existing:
+            await session.execute(delete(cls).where(cls.id.in_(existing)).execution_options(synchronize_session=False))
+        await session.commit()
+        cls.after_write(removed=existing)
+        results = []
+        seen = set()
+        for index, id in enumerate(ids):
+            if id in seen:
+                results.append({"index": index, "id": id, "status": "error", "detail": "Duplicate item in batch"})
+            elif id in existing:
+                results.append({"index": index, "id": id, "status": "deleted", "detail": None})
+            else:
+                results.append({"index": index, "id": id, "status": "not_found", "detail": f"No {cls.__name__} found with id {id}"})
+            seen.add(id)
+        return results
+
     @classmethod
     # Dont user error_handler decorator here
     async def check_if_exists(cls, session, field, value):
@@ -91,9 +277,56 @@ class BaseModel(Base):
         result = await session.execute(query)
         return result.scalars().first()
 
+    @classmethod
+    def keyset_condition(cls, field, order, after):
+        # Rows strictly after the (value, id) pair in an ORDER BY field, id
+        value, last_id = after
+        if field == 'id':
+            return cls.id < last_id if order == 'desc' else cls.id > last_id
+        column = getattr(cls, field)
+        if isinstance(column.type, Float):
+            # MySQL FLOAT is single precision, compared with the double from the cursor a row
+            # would not equal its own value, CAST makes both sides single precision
+            value = cast(value, column.type)
+        if order == 'desc':
+            return or_(column < value, and_(column == value, cls.id > last_id))
+        return or_(column > value, and_(column == value, cls.id > last_id))
+
+    @classmethod
+    @contextmanager
+    def track_shape(cls, conditions, order_field, order):
+        # conditions is a list of (field, comparison, value), streamed queries are timed up to the first row
+        if cls.query_shapes is None:
+            yield
+            return
+        started = time.perf_counter()
+        yield
+        # Only queries that ran, a rejected one says nothing about the indexes needed
+        source = 'catalog' if cls.catalog is not None else 'sql'
+        cls.query_shapes.record(cls, conditions, order_field, order, time.perf_counter() - started, source)
+
+    @classmethod
+    async def fetch(cls, session, query, not_found, limit=None, stream=False, after=None):
+        # Past the last page (after is set) there is nothing left rather than nothing found
+        if not stream:
+            results = (await session.execute(query.limit(peek_limit(limit)))).scalars().all()
+            if not results and after is None:
+                raise HTTPException(status_code=404, detail=not_found)
+            return page(results, limit)
+        # Server side cursor, rows are produced while the caller iterates
+        result = (await session.stream(query.limit(limit))).scalars()
+        try:
+            first = await result.__anext__()
+        except StopAsyncIteration:
+            await result.close()
+            if after is None:
+                raise HTTPException(status_code=404, detail=not_found)
+            return []
+        return prepend(first, result)
+
     @classmethod
     @error_handler
-    async def get_by_filters(cls, session, filters: dict, order: str = 'asc'):
+    async def get_by_filters(cls, session, filters: dict, order: str = 'asc', limit=None, after=None, stream=False):
         comparison_mapping = {
             'eq': lambda field, value: getattr(cls, field) == value,
             'gt': lambda field, value: getattr(cls, field) > value,
@@ -127,21 +360,32 @@ class BaseModel(Base):
                 raise HTTPException(status_code=400, detail=f"Invalid comparison operator: {comparison}, Valid values are: {', '.join(f'{k}={v}' for k, v in comparison_descriptions.items())}")
             conditions.append(comparison_mapping[comparison](field, value))
 
-        query = select(cls).where(and_(*conditions))
+        # Results are ordered by the first filter field, or by id when there is none
+        order_field = list(filters.keys())[0] if filters and order in order_mapping else None
+        not_found = f"No {cls.__name__} found with given filters"
+        shape = [(field, comparison, value) for field, (comparison, value) in filters.items()]
 
-        if filters and order in order_mapping:
-            query = query.order_by(order_mapping[order](list(filters.keys())[0]))
+        with cls.track_shape(shape, order_field, order):
+            if cls.catalog is not None:
+                results = cls.catalog.get_filtered(shape, order_field, order, after, peek_limit(limit))
+                if not results and after is None:
+                    raise HTTPException(status_code=404, detail=not_found)
+                return page(results, limit)
 
-        result = await session.execute(query)
-        results = result.scalars().all()
+            if after is not None:
+                conditions.append(cls.keyset_condition(order_field or 'id', order, after))
+            query = select(cls).where(and_(*conditions))
 
-        if not results:
-            raise HTTPException(status_code=404, detail=f"No {cls.__name__} found with given filters")
-        return results
+            if order_field is not None:
+                query = query.order_by(order_mapping[order](order_field), cls.id)
+            else:
+                query = query.order_by(cls.id)
+
+            return await cls.fetch(session, query, not_found, limit, stream, after)
 
     @classmethod
     @error_handler
-    async def get_by_field_value(cls, session, field, value, comparison: str = 'eq', order: str = 'asc'):
+    async def get_by_field_value(cls, session, field, value, comparison: str = 'eq', order: str = 'asc', limit=None, after=None, stream=False):
         if not hasattr(cls, field):
             raise HTTPException(status_code=400, detail=f"Invalid field: {field}")
         
@@ -175,23 +419,26 @@ class BaseModel(Base):
             raise HTTPException(status_code=400, detail=f"Invalid comparison operator: {comparison}, Valid values are: {', '.join(f'{k}={v}' for k, v in comparison_descriptions.items())}")
         if order not in order_mapping:
             raise HTTPException(status_code=400, detail=f"Invalid order: {order}, Valid values are: {', '.join(f'{k}={v}' for k, v in order_descriptions.items())}")
-        
-        query = select(cls).where(comparison_mapping[comparison])
-        if order == 'asc':
-            query = query.order_by(getattr(cls, field))
-        elif order == 'desc':
-            query = query.order_by(desc(getattr(cls, field)))
-        
-        result = await session.execute(query)
-        results = result.scalars().all()
 
-        if not results:
-            raise HTTPException(status_code=404, detail=f"No {cls.__name__} found with field {field} {comparison_descriptions[comparison]} {value}")
-        return results
+        not_found = f"No {cls.__name__} found with field {field} {comparison_descriptions[comparison]} {value}"
+
+        with cls.track_shape([(field, comparison, value)], field, order):
+            if cls.catalog is not None:
+                results = cls.catalog.get_filtered([(field, comparison, value)], field, order, after, peek_limit(limit))
+                if not results and after is None:
+                    raise HTTPException(status_code=404, detail=not_found)
+                return page(results, limit)
+
+            query = select(cls).where(comparison_mapping[comparison])
+            if after is not None:
+                query = query.where(cls.keyset_condition(field, order, after))
+            query = query.order_by(order_mapping[order], cls.id)
+
+            return await cls.fetch(session, query, not_found, limit, stream, after)
 
     @classmethod
     @error_handler
-    async def get_by_field_sorted(cls, session, field, order='asc'):
+    async def get_by_field_sorted(cls, session, field, order='asc', limit=None, after=None, stream=False):
         if not hasattr(cls, field):
             raise HTTPException(status_code=400, detail=f"Invalid field: {field}")
         order_mapping = {
@@ -205,31 +452,114 @@ class BaseModel(Base):
         if order not in order_mapping:
             raise HTTPException(status_code=400, detail=f"Invalid order: {order}, Valid values are: {', '.join(f'{k}={v}' for k, v in order_descriptions.items())}")
 
-        if order == 'asc':
-            order_func = getattr(cls, field).asc()
-        elif order == 'desc':
-            order_func = getattr(cls, field).desc()
+        not_found = f"No {cls.__name__} found"
+
+        with cls.track_shape([], field, order):
+            if cls.catalog is not None:
+                results = cls.catalog.get_sorted(field, order, after, peek_limit(limit))
+                if not results and after is None:
+                    raise HTTPException(status_code=404, detail=not_found)
+                return page(results, limit)
+
+            query = select(cls)
+            if after is not None:
+                query = query.where(cls.keyset_condition(field, order, after))
+            query = query.order_by(order_mapping[order], cls.id)
 
-        result = await session.execute(select(cls).order_by(order_func))
-        if not result.scalars().all():
-            raise HTTPException(status_code=404, detail=f"No {cls.__name__} found")
-        return result.scalars().all()
+            return await cls.fetch(session, query, not_found, limit, stream, after)
     
     @classmethod
     @error_handler
     async def get_by_id(cls, session, id):
+        if cls.catalog is not None:
+            result = cls.catalog.get_by_id(id)
+            if result is None:
+                raise HTTPException(status_code=404, detail=f"No {cls.__name__} found with id {id}")
+            return result
         result = (await session.execute(select(cls).where(cls.id == id))).scalar_one_or_none()
         if result is None:
             raise HTTPException(status_code=404, detail=f"No {cls.__name__} found with id {id}")
         return result
 
+    @classmethod
+    async def rows_by_id(cls, session, ids):
+        # One IN query, or catalog lookups, for rows that are needed by id
+        if cls.catalog is not None:
+            rows = (cls.catalog.get_by_id(id) for id in ids)
+            return {row.id: row for row in rows if row is not None}
+        if not ids:
+            return {}
+        return {row.id: row for row in (await session.execute(select(cls).where(cls.id.in_(ids)))).scalars()}
+
     @classmethod
     @error_handler
-    async def get_all(cls, session):
-        result = (await session.execute(select(cls))).scalars().all()
-        if not result:
-            raise HTTPException(status_code=404, detail=f"No {cls.__name__} found")
-        return result
+    async def get_by_ids(cls, session, ids):
+        # In the given order, ids without a row are left out
+        rows = await cls.rows_by_id(session, ids)
+        return [rows[id] for id in ids if id in rows]
+
+    @classmethod
+    @error_handler
+    async def get_all(cls, session, limit=None, after=None, stream=False):
+        not_found = f"No {cls.__name__} found"
+        if cls.catalog is not None:
+            result = cls.catalog.get_all(after, peek_limit(limit))
+            if not result and after is None:
+                raise HTTPException(status_code=404, detail=not_found)
+            return page(result, limit)
+        query = select(cls)
+        if after is not None:
+            query = query.where(cls.keyset_condition('id', 'asc', after))
+        return await cls.fetch(session, query.order_by(cls.id), not_found, limit, stream, after)
+
+    @classmethod
+    @error_handler
+    async def get_stats(cls, session, group_by=(), metrics=(), bins=10):
+        columns = cls.__table__.columns
+        for field in [*group_by, *metrics]:
+            if field not in columns:
+                raise HTTPException(status_code=400, detail=f"Invalid field: {field}")
+        text_fields = {column.name for column in columns if isinstance(column.type, (String, Enum))}
+        for field in metrics:
+            if field in text_fields:
+                raise HTTPException(status_code=400, detail=f"Not a numeric field: {field}")
+        if cls.catalog is not None:
+            return cls.catalog.get_stats(list(group_by), list(metrics), bins)
+        # Only the needed columns are read, the aggregation itself runs in NumPy like in catalog mode
+        fields = list(dict.fromkeys([*group_by, *metrics]))
+        result = await session.execute(select(*(columns[field] for field in fields)))
+        return ColumnarTable(result.all(), fields, text_fields).aggregate(list(group_by), list(metrics), bins)
+
+    @classmethod
+    @error_handler
+    async def search(cls, session, query, limit=10, fuzzy=True):
+        # Returns (row, match) pairs in the order ranked by the name index
+        if cls.name_index is None:
+            raise HTTPException(status_code=503, detail="Search is not available")
+        matches = cls.name_index.search(query, limit, fuzzy)
+        rows = await cls.rows_by_id(session, [id for id, _ in matches])
+        return [(rows[id], match) for id, match in matches if id in rows]
+
+    @classmethod
+    @error_handler
+    async def similar(cls, session, id, k=10, fields=None):
+        # Returns (row, distance) pairs, closest first
+        if cls.similarity_index is None:
+            raise HTTPException(status_code=503, detail="Similarity search is not available")
+        for field in fields:
+            if field not in cls.similarity_index.fields:
+                raise HTTPException(status_code=400, detail=f"Invalid field: {field}")
+        matches = cls.similarity_index.nearest(id, k, fields)
+        if matches is None:
+            raise HTTPException(status_code=404, detail=f"No {cls.__name__} found with id {id}")
+        rows = await cls.rows_by_id(session, [match_id for match_id, _ in matches])
+        return [(rows[match_id], distance) for match_id, distance in matches if match_id in rows]
+
+class AppMeta(Base):
+    # Key/value state of the database itself, e.g. the checksum of the seeded Cereal.csv
+    __tablename__ = 'app_meta'
+    key = Column(String(50), primary_key=True)
+    value = Column(String(255))
 
 class Cereal(BaseModel):
     __tablename__ = 'cereals'
@@ -272,6 +602,8 @@ class User(BaseModel):
     email = Column(String(50), unique=True, nullable=False)
     password = Column(String(255), nullable=False)
     is_admin = Column(String(10), default="False")
+    # Part of every issued token, bumping it revokes all of the user's tokens
+    token_version = Column(Integer, default=0, server_default='0', nullable=False)
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
@@ -293,10 +625,19 @@ class User(BaseModel):
     @classmethod
     @error_handler
     async def create_user(cls, session, username, password, email, is_admin="False"):
-        user = cls(username=username, password=generate_password_hash(password), email=email, is_admin=is_admin)
+        user = cls(username=username, password=await password_hasher.hash(password), email=email, is_admin=is_admin)
         session.add(user)
-        await session.commit()
-        await session.refresh(user)
+        # The unique indexes decide about duplicates, defaults are set on the instance during flush
+        try:
+            await session.commit()
+        except IntegrityError as e:
+            await session.rollback()
+            key = violated_unique_key(e)
+            if key == "username":
+                raise HTTPException(status_code=400, detail="Username already exists")
+            if key == "email":
+                raise HTTPException(status_code=400, detail="Email already exists")
+            raise
         return user
     
     @classmethod
@@ -304,11 +645,28 @@ class User(BaseModel):
     async def authenticate(cls, username: str, password: str, session: AsyncSession):
         user = await session.execute(select(cls).where(cls.username == username))
         user = user.scalars().first()
-        if user and user.check_password(password):
-            return user
-        return None
+        if not user or not isinstance(user.password, str):
+            return None
+        if not await password_hasher.verify(user.password, password):
+            return None
+        # Move the stored hash to the configured cost the next time the password is known
+        if await password_hasher.needs_rehash(user.password):
+            user.password = await password_hasher.hash(password)
+            await session.commit()
+        return user
     
     def check_password(self, password):
         if not isinstance(self.password, str):
             raise ValueError("Invalid password")
         return check_password_hash(self.password, password)
+
+    @classmethod
+    @error_handler
+    async def revoke_tokens(cls, session, username):
+        result = await session.execute(update(cls).where(cls.username == username).values(token_version=cls.token_version + 1).execution_options(synchronize_session=False))
+        await session.commit()
+        if result.rowcount == 0:
+            raise HTTPException(status_code=404, detail=f"No {cls.__name__} found with username {username}")
+        # Other workers may still have the user's principal cached
+        if cls.write_listener is not None:
+            cls.write_listener()
@@ -0,0 +1,148 @@
+import operator
+import threading
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+comparison_operators = {
+    'eq': operator.eq,
+    'gt': operator.gt,
+    'lt': operator.lt,
+    'gte': operator.ge,
+    'lte': operator.le,
+    'ne': operator.ne,
+}
+
+class ColumnarTable:
+    """NumPy column arrays over a list of rows, filtered with boolean masks.
+
+    Numeric columns are stored as float64. Text columns are dictionary encoded
+    into int64 codes over their sorted, casefolded distinct values, so both
+    comparisons and ordering become integer operations.
+    """
+
+    def __init__(self, rows, fields, text_fields):
+        self.rows = rows
+        self.fields = list(fields)
+        self.size = len(rows)
+        self.values = {}
+        self.dictionaries = {}
+        self.permutations = {}
+        self.lock = threading.Lock()
+        for index, field in enumerate(fields):
+            if field in text_fields:
+                keys = np.array([row[index].casefold() for row in rows], dtype=object)
+                uniques, codes = np.unique(keys, return_inverse=True) if self.size else (keys, np.empty(0, dtype=np.int64))
+                self.dictionaries[field] = uniques.tolist()
+                self.values[field] = codes.astype(np.int64)
+            else:
+                self.values[field] = np.fromiter((row[index] for row in rows), dtype=np.float64, count=self.size)
+
+    def mask(self, field, comparison, value):
+        column = self.values[field]
+        if field not in self.dictionaries:
+            return comparison_operators[comparison](column, value)
+        # Translate the text value into a code range within the sorted dictionary
+        dictionary = self.dictionaries[field]
+        left = bisect_left(dictionary, value)
+        right = bisect_right(dictionary, value)
+        if comparison == 'eq':
+            return (column >= left) & (column < right)
+        if comparison == 'ne':
+            return (column < left) | (column >= right)
+        if comparison == 'lt':
+            return column < left
+        if comparison == 'lte':
+            return column < right
+        if comparison == 'gt':
+            return column >= right
+        return column >= left
+
+    def permutation(self, field, descending=False):
+        # Sort permutations are computed once per column and direction, then reused
+        key = (field, descending)
+        perm = self.permutations.get(key)
+        if perm is None:
+            with self.lock:
+                perm = self.permutations.get(key)
+                if perm is None:
+                    column = self.values[field]
+                    perm = np.argsort(-column if descending else column, kind='stable')
+                    self.permutations[key] = perm
+        return perm
+
+    def take(self, indexes):
+        rows = self.rows
+        return [rows[i] for i in indexes.tolist()]
+
+    def after_mask(self, field, descending, value, last_id):
+        # Keyset condition for ORDER BY field, id: rows strictly after (value, last_id)
+        ids = self.values['id']
+        if field == 'id':
+            return ids < last_id if descending else ids > last_id
+        beyond = self.mask(field, 'lt' if descending else 'gt', value)
+        return beyond | (self.mask(field, 'eq', value) & (ids > last_id))
+
+    def select(self, conditions, order_field=None, descending=False, after=None, limit=None):
+        # conditions is a list of (field, comparison, coerced value)
+        mask = np.ones(self.size, dtype=bool)
+        for field, comparison, value in conditions:
+            mask &= self.mask(field, comparison, value)
+        if after is not None:
+            mask &= self.after_mask(order_field or 'id', descending, *after)
+        if order_field is None:
+            indexes = np.flatnonzero(mask)
+        else:
+            perm = self.permutation(order_field, descending)
+            indexes = perm[mask[perm]]
+        if limit is not None:
+            indexes = indexes[:limit]
+        return self.take(indexes)
+
+    def sort(self, field, descending=False):
+        return self.take(self.permutation(field, descending))
+
+    def aggregate(self, group_by, metrics, bins=10):
+        """Count, mean, min, max and a histogram of each metric per distinct group_by combination.
+
+        Histogram edges are shared by all groups so their counts can be compared.
+        """
+        if self.size == 0:
+            return {"count": 0, "edges": {}, "groups": []}
+        if group_by:
+            keys = np.stack([self.values[field] for field in group_by], axis=1)
+            _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+            inverse = inverse.reshape(-1)
+        else:
+            first, inverse = np.zeros(1, dtype=np.int64), np.zeros(self.size, dtype=np.int64)
+        groups = len(first)
+        counts = np.bincount(inverse, minlength=groups)
+        # Rows ordered by group, so min and max become one reduceat per column
+        order = np.argsort(inverse, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        edges, stats = {}, {}
+        for field in metrics:
+            column = self.values[field]
+            sums = np.bincount(inverse, weights=column, minlength=groups)
+            edges[field] = np.histogram_bin_edges(column, bins)
+            buckets = np.clip(np.searchsorted(edges[field], column, side='right') - 1, 0, bins - 1)
+            histograms = np.bincount(inverse * bins + buckets, minlength=groups * bins).reshape(groups, bins)
+            stats[field] = (
+                (sums / counts).tolist(),
+                np.minimum.reduceat(column[order], starts).tolist(),
+                np.maximum.reduceat(column[order], starts).tolist(),
+                histograms.tolist(),
+            )
+        # Group labels are taken from a row of the group, keeping the stored casing and type
+        indexes = [self.fields.index(field) for field in group_by]
+        result = []
+        for group, row_index in enumerate(first.tolist()):
+            row = self.rows[row_index]
+            result.append({
+                "key": {field: row[index] for field, index in zip(group_by, indexes)},
+                "count": int(counts[group]),
+                "metrics": {
+                    field: {"mean": mean[group], "min": low[group], "max": high[group], "histogram": histogram[group]}
+                    for field, (mean, low, high, histogram) in stats.items()
+                },
+            })
+        return {"count": self.size, "edges": {field: values.tolist() for field, values in edges.items()}, "groups": result}
@@ -1,36 +1,257 @@
 import json
+import time
+import threading
+from contextvars import ContextVar
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from metrics import db_statement_duration, db_statement_errors, db_pool_wait
+
+class PoolStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+
+    def record_wait(self, seconds, timed_out=False):
+        db_pool_wait.observe(seconds)
+        with self.lock:
+            self.wait_count += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": round(self.wait_total / self.wait_count * 1000, 3) if self.wait_count else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+class StatementStats:
+    __slots__ = ('count', 'seconds', 'writes')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.writes = 0
+
+# Set per request by the middleware in main, statements executed while handling it are added up here
+current_statements = ContextVar('current_statements', default=None)
+
+STATEMENT_OPERATIONS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+WRITE_OPERATIONS = ('INSERT', 'UPDATE', 'DELETE')
+
+def statement_operation(statement):
+    # Keeps the label set small, everything else (DDL, EXPLAIN, pings) is "OTHER"
+    words = (statement or '').split(None, 1)
+    operation = words[0].upper() if words else ''
+    return operation if operation in STATEMENT_OPERATIONS else 'OTHER'
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # Measures how long each checkout waits for a free connection
+    stats = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except Exception:
+            if self.stats:
+                self.stats.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        if self.stats:
+            self.stats.record_wait(time.perf_counter() - start)
+        return conn
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
 
 class DatabaseConnect:
-    def __init__(self, db_url):
+    def __init__(self, db_url, pool_size=5, max_overflow=10, pool_pre_ping=True, pool_recycle=3600, pool_timeout=30, connect_args=None):
+        if connect_args is None:
+            connect_args = {'connect_timeout': 5}
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.stats = PoolStats()
+        self.config = {}
+        # Read replicas, each a DatabaseConnect of its own, see get_read_session
+        self.replicas = []
+        self.next_replica = 0
+        self.retry_seconds = 30
+        self.unhealthy_until = 0.0
         self.engine = create_async_engine(
             db_url,
-            connect_args={'connect_timeout': 5}
-            #,echo=True
+            connect_args=connect_args,
+            poolclass=TimedQueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=pool_pre_ping,
+            pool_recycle=pool_recycle,
+            pool_timeout=pool_timeout,
+            #echo=True
         )
+        self.engine.pool.stats = self.stats
         self.sessionmaker = sessionmaker(self.engine, expire_on_commit=False, class_=AsyncSession)
+        self._add_pool_listeners()
+        self._add_statement_listeners()
+
+    def _add_pool_listeners(self):
+        stats = self.stats
+
+        @event.listens_for(self.engine.sync_engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            with stats.lock:
+                stats.connects += 1
+
+        @event.listens_for(self.engine.sync_engine, "checkout")
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            with stats.lock:
+                stats.checkouts += 1
+
+        @event.listens_for(self.engine.sync_engine, "checkin")
+        def on_checkin(dbapi_connection, connection_record):
+            with stats.lock:
+                stats.checkins += 1
+
+        @event.listens_for(self.engine.sync_engine, "invalidate")
+        def on_invalidate(dbapi_connection, connection_record, exception):
+            with stats.lock:
+                stats.invalidations += 1
+
+    def _add_statement_listeners(self):
+        @event.listens_for(self.engine.sync_engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+        def record(conn, statement, failed=False):
+            starts = conn.info.get('query_start')
+            if not starts:
+                return
+            elapsed = time.perf_counter() - starts.pop()
+            operation = statement_operation(statement)
+            stats = current_statements.get()
+            if stats is not None:
+                stats.count += 1
+                stats.seconds += elapsed
+                if operation in WRITE_OPERATIONS:
+                    stats.writes += 1
+            db_statement_duration.observe(elapsed, operation=operation)
+            if failed:
+                db_statement_errors.inc(operation=operation)
+
+        @event.listens_for(self.engine.sync_engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            record(conn, statement)
+
+        @event.listens_for(self.engine.sync_engine, "handle_error")
+        def handle_error(exception_context):
+            # Failed statements are round trips too
+            if exception_context.connection is not None:
+                record(exception_context.connection, exception_context.statement, failed=True)
+            # Lost or refused connections take this engine out of read routing for a while
+            if exception_context.is_disconnect or exception_context.connection is None:
+                self.unhealthy_until = time.monotonic() + self.retry_seconds
 
     async def get_new_session(self):
-        self.session = self.sessionmaker()
-        return self.session
+        return self.sessionmaker()
+
+    def is_healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def pick_replica(self):
+        # Least checked out connections first, ties go round robin
+        healthy = [replica for replica in self.replicas if replica.is_healthy()]
+        if not healthy:
+            return None
+        start = self.next_replica % len(healthy)
+        self.next_replica += 1
+        rotated = healthy[start:] + healthy[:start]
+        return min(rotated, key=lambda replica: replica.engine.pool.checkedout())
+
+    async def get_read_session(self, primary=False):
+        # Falls back to the primary without replicas or when none is healthy
+        replica = None if primary else self.pick_replica()
+        return await (replica or self).get_new_session()
+
+    def pool_status(self):
+        pool = self.engine.pool
+        checked_out = pool.checkedout()
+        capacity = self.pool_size + self.max_overflow
+        status = {
+            "pool_size": self.pool_size,
+            "max_overflow": self.max_overflow,
+            "checked_out": checked_out,
+            "checked_in": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "saturation": round(checked_out / capacity, 3) if capacity else 0.0,
+            "healthy": self.is_healthy(),
+            **self.stats.as_dict(),
+        }
+        if self.replicas:
+            status["replicas"] = [replica.pool_status() for replica in self.replicas]
+        return status
 
     async def close(self):
-        await self.session.close()
+        for replica in self.replicas:
+            await replica.close()
         await self.engine.dispose()
-            
+
     @staticmethod
-    async def connect_from_config():
+    def load_config():
         # Load database information from db_info.json
         with open('db_info.json') as f:
-            db_info = json.load(f)
+            return json.load(f)
 
+    @staticmethod
+    def build_url(db_info, database_name=None):
+        # A full SQLAlchemy async URL, e.g. sqlite+aiosqlite for local runs, takes precedence
+        if 'url' in db_info:
+            return db_info['url']
         username = db_info['username']
         password = db_info['password']
         hostname = db_info['hostname']
-        database_name = db_info['db_name']
+        if database_name is None:
+            database_name = db_info['db_name']
+        return f"mysql+aiomysql://{username}:{password}@{hostname}/{database_name}"
 
-        db_url = f"mysql+aiomysql://{username}:{password}@{hostname}/{database_name}"
-        db_connect = DatabaseConnect(db_url)
+    @staticmethod
+    def from_info(db_info):
+        db_connect = DatabaseConnect(
+            DatabaseConnect.build_url(db_info),
+            pool_size=db_info.get('pool_size', 5),
+            max_overflow=db_info.get('max_overflow', 10),
+            pool_pre_ping=db_info.get('pool_pre_ping', True),
+            pool_recycle=db_info.get('pool_recycle', 3600),
+            pool_timeout=db_info.get('pool_timeout', 30),
+            connect_args=db_info.get('connect_args'),
+        )
+        db_connect.config = db_info
+        db_connect.retry_seconds = db_info.get('replica_retry_seconds', 30)
+        return db_connect
 
-        return db_connect
\ No newline at end of file
+    @staticmethod
+    async def connect_from_config():
+        db_info = DatabaseConnect.load_config()
+        db_connect = DatabaseConnect.from_info(db_info)
+        # Replicas inherit the primary settings and override e.g. hostname, or give their own url
+        for replica_info in db_info.get('replicas', []):
+            merged = {key: value for key, value in db_info.items() if key not in ('replicas', 'url')}
+            merged.update(replica_info)
+            db_connect.replicas.append(DatabaseConnect.from_info(merged))
+        return db_connect
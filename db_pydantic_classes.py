@@ -2,7 +2,7 @@ from pydantic import BaseModel, EmailStr, Field
 from typing import Optional
 from enum import Enum
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 
 class Token(BaseModel):
@@ -68,6 +68,31 @@ class CerealInDB(BaseModel):
     class Config:
         orm_mode = True
 
+class CerealSearchResult(CerealInDB):
+    match: str
+
+class CerealSimilarResult(CerealInDB):
+    distance: float
+
+class CerealBatchItem(CerealBase):
+    id: Optional[int] = None
+
+class BatchItemResult(BaseModel):
+    index: int
+    id: Optional[int]
+    status: str
+    detail: Optional[str] = None
+
+class ImportErrorItem(BaseModel):
+    line: int
+    detail: str
+
+class ImportResult(BaseModel):
+    created: int = 0
+    updated: int = 0
+    failed: int = 0
+    errors: List[ImportErrorItem] = []
+
 class FilterExample(BaseModel):
     filters: Dict[str, Any] = Field(..., example={
         "calories": ["lt", 100],
@@ -0,0 +1,123 @@
+import csv
+import hashlib
+import logging
+from sqlalchemy import inspect, text, func
+from sqlalchemy.future import select
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.ext.asyncio import create_async_engine
+from db_classes import Base, AppMeta, Cereal, User
+from db_connect import DatabaseConnect
+
+logger = logging.getLogger(__name__)
+
+CEREAL_CSV = 'Cereal.csv'
+SEED_BATCH_SIZE = 1000
+SEED_USERS = [
+    ('user', 'user', 'user@user.com', "False"),
+    ('admin', 'admin', 'admin@admin.com', "True"),
+]
+
+def clean_rating(value):
+    # ratings in Cereal.csv have 2 decimal points, we just take first number
+    if isinstance(value, str) and value.count('.') > 1:
+        return float(value.split('.')[0])
+    return float(value)
+
+def read_cereals(path=CEREAL_CSV):
+    # The second line of the file holds the column types
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f, delimiter=';'))[1:]
+    cereals = []
+    for row in rows:
+        row['rating'] = clean_rating(row['rating'])
+        for field in ('calories', 'protein', 'fat', 'sodium', 'sugars', 'potass', 'vitamins', 'shelf'):
+            row[field] = int(row[field])
+        for field in ('fiber', 'carbo', 'weight', 'cups'):
+            row[field] = float(row[field])
+        cereals.append(row)
+    return cereals
+
+def file_checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class DatabaseSetup:
+    """Idempotent startup: creates what is missing and seeds only when Cereal.csv changed."""
+
+    def __init__(self, db_connect):
+        self.db = db_connect
+
+    async def run(self):
+        await self.create_databases()
+        await self.migrate()
+        await self.seed_cereals()
+        await self.seed_users()
+
+    async def create_databases(self):
+        db_info = self.db.config
+        # With a full url in db_info.json the database is expected to exist
+        if self.db.engine.dialect.name != 'mysql' or 'url' in db_info:
+            return
+        # Server level connection, the application database may not exist yet
+        engine = create_async_engine(DatabaseConnect.build_url(db_info, database_name=''))
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text(f"CREATE DATABASE IF NOT EXISTS {db_info['db_name']}"))
+                if 'test_db_name' in db_info:
+                    await conn.execute(text(f"CREATE DATABASE IF NOT EXISTS {db_info['test_db_name']}"))
+        finally:
+            await engine.dispose()
+
+    async def migrate(self):
+        async with self.db.engine.begin() as conn:
+            await conn.run_sync(self.migrate_sync)
+
+    @staticmethod
+    def migrate_sync(conn):
+        # Create missing tables, then add columns that were added to existing models
+        Base.metadata.create_all(bind=conn)
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+
+    async def get_meta(self, session, key):
+        return (await session.execute(select(AppMeta.value).where(AppMeta.key == key))).scalar_one_or_none()
+
+    async def set_meta(self, session, key, value):
+        row = await session.get(AppMeta, key)
+        if row is None:
+            session.add(AppMeta(key=key, value=value))
+        else:
+            row.value = value
+        await session.commit()
+
+    async def seed_cereals(self, path=CEREAL_CSV):
+        checksum = file_checksum(path)
+        async with await self.db.get_new_session() as session:
+            if await self.get_meta(session, 'cereal_csv_sha256') == checksum:
+                return False
+            # Upsert by name, cereals added through the API are kept
+            cereals = read_cereals(path)
+            failed = []
+            for start in range(0, len(cereals), SEED_BATCH_SIZE):
+                results = await Cereal.bulk_upsert(session, cereals[start:start + SEED_BATCH_SIZE])
+                failed += [(start + result["index"], result["detail"]) for result in results if result["status"] not in ("created", "updated")]
+            if failed:
+                # Without the checksum the seed is tried again on the next start
+                for index, detail in failed:
+                    logger.warning("Cereal %r from %s was not seeded: %s", cereals[index]['name'], path, detail)
+                return False
+            await self.set_meta(session, 'cereal_csv_sha256', checksum)
+        return True
+
+    async def seed_users(self):
+        async with await self.db.get_new_session() as session:
+            if (await session.execute(select(func.count()).select_from(User))).scalar():
+                return False
+            for username, password, email, is_admin in SEED_USERS:
+                await User.create_user(session, username=username, password=password, email=email, is_admin=is_admin)
+        return True
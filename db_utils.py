@@ -7,6 +7,7 @@ from db_classes import *
 from sqlalchemy import inspect
 from werkzeug.security import generate_password_hash, check_password_hash
 import asyncio
+from password_hashing import password_hasher
 
 class DatabaseUtils:
 
@@ -36,7 +37,7 @@ class DatabaseUtils:
 
     def generate_user(self, username, password, email, is_admin="False"):
         db = self.SessionLocal()
-        user = User(username=username, email=email, password=generate_password_hash(password), is_admin=is_admin)
+        user = User(username=username, email=email, password=generate_password_hash(password, password_hasher.method), is_admin=is_admin)
         db.add(user)
         db.commit()
         db.close()
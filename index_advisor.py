@@ -0,0 +1,171 @@
+import threading
+from collections import namedtuple
+from sqlalchemy import Index, MetaData, and_, inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.future import select
+from db_columns import comparison_operators
+
+RANGE_COMPARISONS = ('gt', 'lt', 'gte', 'lte')
+
+QueryShape = namedtuple('QueryShape', ['table', 'conditions', 'order_field', 'order'])
+
+class ShapeStats:
+    __slots__ = ('count', 'seconds', 'max_seconds', 'sources', 'sample')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.sources = {}
+        self.sample = None
+
+class QueryShapeRecorder:
+    """Counts and times the filter and ordering shapes used by the query builders.
+
+    A shape is the set of (field, comparison) pairs plus the ordering, without the values.
+    The values of the last query of each shape are kept as a sample to run EXPLAIN with.
+    """
+
+    def __init__(self, max_shapes=1000):
+        self.max_shapes = max_shapes
+        self.shapes = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def record(self, model, conditions, order_field, order, seconds, source):
+        # conditions is a list of (field, comparison, value)
+        columns = model.__table__.columns
+        if any(field not in columns for field, _, _ in conditions) or (order_field is not None and order_field not in columns):
+            return
+        shape = QueryShape(model.__tablename__, tuple(sorted((field, comparison) for field, comparison, _ in conditions)), order_field or 'id', order)
+        with self.lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                if len(self.shapes) >= self.max_shapes:
+                    self.dropped += 1
+                    return
+                stats = self.shapes[shape] = ShapeStats()
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.sources[source] = stats.sources.get(source, 0) + 1
+            stats.sample = list(conditions)
+
+    def hottest(self, top=None):
+        # Most total time first, that is where an index saves the most
+        with self.lock:
+            items = sorted(self.shapes.items(), key=lambda item: item[1].seconds, reverse=True)
+        return items[:top] if top is not None else items
+
+    def reset(self):
+        with self.lock:
+            self.shapes = {}
+            self.dropped = 0
+
+    def stats(self, top=None):
+        return [
+            {
+                "table": shape.table,
+                "conditions": [list(condition) for condition in shape.conditions],
+                "order_field": shape.order_field,
+                "order": shape.order,
+                "count": stats.count,
+                "total_ms": round(stats.seconds * 1000, 3),
+                "avg_ms": round(stats.seconds * 1000 / stats.count, 3),
+                "max_ms": round(stats.max_seconds * 1000, 3),
+                "sources": dict(stats.sources),
+            }
+            for shape, stats in self.hottest(top)
+        ]
+
+def index_columns(shape):
+    # Equality columns first, then the ordering column, then one range column
+    columns = sorted({field for field, comparison in shape.conditions if comparison == 'eq'})
+    if shape.order_field != 'id' and shape.order_field not in columns:
+        columns.append(shape.order_field)
+    ranges = [field for field, comparison in shape.conditions if comparison in RANGE_COMPARISONS and field not in columns]
+    if ranges:
+        columns.append(ranges[0])
+    return columns
+
+def index_name(table, columns):
+    # MySQL limits identifiers to 64 characters
+    return f"ix_{table}_{'_'.join(columns)}"[:64]
+
+class IndexAdvisor:
+    """Proposes composite indexes for the hottest recorded shapes, checked with EXPLAIN."""
+
+    def __init__(self, engine, recorder):
+        self.engine = engine
+        self.recorder = recorder
+
+    @staticmethod
+    def existing_indexes(sync_connection, table):
+        inspector = inspect(sync_connection)
+        indexes = [index['column_names'] for index in inspector.get_indexes(table)]
+        indexes += [constraint['column_names'] for constraint in inspector.get_unique_constraints(table)]
+        indexes.append(inspector.get_pk_constraint(table)['constrained_columns'])
+        return indexes
+
+    @staticmethod
+    def is_covered(columns, indexes):
+        return any(index[:len(columns)] == columns for index in indexes)
+
+    def sample_query(self, model, shape, sample):
+        conditions = [comparison_operators[comparison](getattr(model, field), value) for field, comparison, value in sample]
+        order_column = getattr(model, shape.order_field)
+        query = select(model).where(and_(*conditions))
+        return query.order_by(order_column.desc() if shape.order == 'desc' else order_column.asc(), model.id)
+
+    async def explain(self, connection, query):
+        dialect = self.engine.dialect
+        prefix = "EXPLAIN QUERY PLAN" if dialect.name == 'sqlite' else "EXPLAIN"
+        sql = str(query.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+        result = await connection.execute(text(f"{prefix} {sql}"))
+        return [dict(row._mapping) for row in result]
+
+    async def advise(self, models, top=5, apply=False):
+        models = {model.__tablename__: model for model in models}
+        advice = []
+        async with self.engine.connect() as connection:
+            indexes = {}
+            for shape, stats in self.recorder.hottest(top):
+                model = models.get(shape.table)
+                if model is None:
+                    continue
+                if shape.table not in indexes:
+                    indexes[shape.table] = await connection.run_sync(self.existing_indexes, shape.table)
+                columns = index_columns(shape)
+                # One bad sample is reported with its shape instead of failing the whole advice
+                try:
+                    query = self.sample_query(model, shape, stats.sample)
+                    explain, error = await self.explain(connection, query), None
+                except (SQLAlchemyError, AttributeError, TypeError, ValueError) as e:
+                    query, explain, error = None, None, f"{type(e).__name__}: {e}"
+                item = {
+                    "table": shape.table,
+                    "conditions": [list(condition) for condition in shape.conditions],
+                    "order_field": shape.order_field,
+                    "order": shape.order,
+                    "count": stats.count,
+                    "avg_ms": round(stats.seconds * 1000 / stats.count, 3),
+                    "columns": columns,
+                    "index": index_name(shape.table, columns) if columns else None,
+                    "exists": bool(columns) and self.is_covered(columns, indexes[shape.table]),
+                    "explain": explain,
+                    "error": error,
+                    "applied": False,
+                }
+                if apply and columns and not item["exists"]:
+                    # A detached copy of the table, so the model metadata does not collect these indexes
+                    table = model.__table__.to_metadata(MetaData())
+                    index = Index(item["index"], *(table.c[column] for column in columns))
+                    await connection.run_sync(index.create)
+                    await connection.commit()
+                    indexes[shape.table].append(columns)
+                    item["applied"] = True
+                    if query is not None:
+                        # The plan once the index is in place
+                        item["explain"] = await self.explain(connection, query)
+                advice.append(item)
+        return advice
@@ -1,24 +1,48 @@
-from fastapi import FastAPI, HTTPException, status, Depends, Security, Body
+from fastapi import FastAPI, HTTPException, status, Depends, Security, Body, Request, Query, UploadFile, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse, FileResponse
+from fastapi.responses import JSONResponse, RedirectResponse, FileResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, APIKeyHeader
+from fastapi.responses import PlainTextResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.encoders import jsonable_encoder
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match
 
 from db_pydantic_classes import *
 from db_classes import *
-from db_connect import DatabaseConnect
-from db_utils import DatabaseUtils
+from db_connect import DatabaseConnect, StatementStats, current_statements
+from db_catalog import Catalog
+from name_search import NameIndex
+from similarity import SimilarityIndex, NUTRITION_FIELDS
+from change_feed import ChangeFeed
+from index_advisor import QueryShapeRecorder, IndexAdvisor
+from worker_sync import WorkerSync
+from request_profiler import request_profiler, PROFILE_MODES
+from metrics import registry, http_request_duration, http_requests_in_flight, CONTENT_TYPE
+from pictures import PictureIndex, Base64Cache, picture_headers, is_not_modified, parse_range, read_range, zip_pictures, multipart_pictures
+from picture_variants import VariantStore, VARIANT_FORMATS, snap_width
+from auth_cache import PrincipalCache
+from password_hashing import password_hasher, DEFAULT_HASH_METHOD
+from response_cache import ResponseCache
+from csv_transfer import CerealCsvReader, EXPORT_FIELDS, csv_header, csv_lines
+from pagination import decode_cursor, next_cursor_headers, wants_ndjson, ndjson_response
+from db_setup import DatabaseSetup
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 import json
 from typing import List, Dict, Tuple, Any, Optional
+import asyncio
+import mimetypes
 import os
-import base64
+import secrets
+import time
+from urllib.parse import quote
 
 import uvicorn
 #uvicorn main:app --reload
@@ -31,15 +55,159 @@ with open('jwt_info.json') as f:
 SECRET_KEY = jwt_info['secret_key']
 ALGORITHM = jwt_info['algorithm']
 ACCESS_TOKEN_EXPIRE_MINUTES = jwt_info['access_token_expire_minutes']
+PRINCIPAL_CACHE_TTL_SECONDS = jwt_info.get('principal_cache_ttl_seconds', 60)
+# When set, /metrics requires "Authorization: Bearer <metrics_token>"
+METRICS_TOKEN = jwt_info.get('metrics_token')
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 API_KEY_NAME = "User_Authentication"
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=True)
+principal_cache = PrincipalCache(ttl=PRINCIPAL_CACHE_TTL_SECONDS)
+password_hasher.configure(
+    method=jwt_info.get('password_hash_method', DEFAULT_HASH_METHOD),
+    workers=jwt_info.get('password_hash_workers', 2),
+    max_queue=jwt_info.get('password_hash_queue', 16),
+)
 
 
-app = FastAPI()
-app.mount("/cereal-pictures", StaticFiles(directory="Cereal Pictures"), name="cereal-pictures")
+async def setup_database(db_connect, respawned=False):
+    startup_mode = db_connect.config.get('startup_mode', 'auto')
+    if startup_mode == 'reset' and respawned:
+        # A worker respawned by a running master must not drop what its deployment uses
+        startup_mode = 'auto'
+    if startup_mode == 'reset':
+        # Old behaviour: drop everything and seed again, slow and destroys data
+        from db_utils import DatabaseUtils
+        await asyncio.to_thread(DatabaseUtils().setup_db)
+    elif startup_mode == 'auto':
+        await DatabaseSetup(db_connect).run()
+
+def collect_app_metrics():
+    # Read on every scrape from the objects that already keep these counts
+    state = app.state
+    pools = [({"engine": "primary"}, state.db.pool_status())]
+    pools += [({"engine": f"replica{index}"}, replica.pool_status()) for index, replica in enumerate(state.db.replicas)]
+    yield ("db_pool_connections", "gauge", "Pooled connections by state.", [
+        ({**engine, "state": state_name}, pool[state_name]) for engine, pool in pools for state_name in ("checked_out", "checked_in", "overflow")
+    ])
+    yield ("db_pool_capacity", "gauge", "Pool size plus max overflow.", [(engine, pool["pool_size"] + pool["max_overflow"]) for engine, pool in pools])
+    yield ("db_pool_healthy", "gauge", "1 when the engine is used for reads, 0 while it is skipped after errors.", [(engine, int(pool["healthy"])) for engine, pool in pools])
+    yield ("db_pool_checkouts_total", "counter", "Connection checkouts.", [(engine, pool["checkouts"]) for engine, pool in pools])
+    yield ("db_pool_timeouts_total", "counter", "Checkouts that timed out waiting for a connection.", [(engine, pool["timeouts"]) for engine, pool in pools])
+    yield ("db_pool_invalidations_total", "counter", "Connections invalidated after an error.", [(engine, pool["invalidations"]) for engine, pool in pools])
+    caches = {
+        "picture_base64": state.picture_cache.stats(),
+        "response": state.response_cache.stats(),
+        "principal": {"hits": principal_cache.hits, "misses": principal_cache.misses, "entries": len(principal_cache.entries)},
+    }
+    yield ("cache_hits_total", "counter", "Cache hits.", [({"cache": name}, stats["hits"]) for name, stats in caches.items()])
+    yield ("cache_misses_total", "counter", "Cache misses.", [({"cache": name}, stats["misses"]) for name, stats in caches.items()])
+    yield ("cache_entries", "gauge", "Entries held by the cache.", [({"cache": name}, stats["entries"]) for name, stats in caches.items()])
+    yield ("cache_bytes", "gauge", "Bytes held by the cache.", [({"cache": name}, stats["bytes"]) for name, stats in caches.items() if "bytes" in stats])
+    yield ("password_hash_pending", "gauge", "Password hash jobs running or queued.", [({}, password_hasher.pending)])
+    yield ("password_hash_capacity", "gauge", "Hash workers plus queue length, beyond it requests get 503.", [({}, password_hasher.workers + password_hasher.max_queue)])
+    yield ("password_hash_rejected_total", "counter", "Hash jobs rejected because the queue was full.", [({}, password_hasher.rejected)])
+    yield ("picture_variant_jobs_pending", "gauge", "Picture resize jobs in the process pool.", [({}, len(state.picture_variants.pending))])
+    if Cereal.catalog is not None:
+        yield ("catalog_version", "gauge", "Version of the in-process cereal catalog.", [({}, Cereal.catalog.version)])
+    yield ("change_feed_listeners", "gauge", "Open /cereals/changes streams.", [({}, Cereal.change_feed.listeners)])
+    yield ("change_feed_version", "counter", "Change events published by this process.", [({}, Cereal.change_feed.version)])
+
+async def load_caches(db):
+    # Per process copies of the cereal data, loaded at startup and again after another worker wrote
+    async with await db.get_new_session() as session:
+        name_index = NameIndex(Cereal)
+        await name_index.load(session)
+        Cereal.name_index = name_index
+        similarity_index = SimilarityIndex(Cereal)
+        await similarity_index.load(session)
+        Cereal.similarity_index = similarity_index
+        if db.config.get('catalog_mode', False):
+            # Serve cereal reads from an in-process snapshot instead of MySQL
+            catalog = Cereal.catalog or Catalog(Cereal)
+            await catalog.load(session)
+            Cereal.catalog = catalog
+
+async def reload_caches(app):
+    sync = app.state.worker_sync
+    async with app.state.reload_lock:
+        # Read first, a write that lands during the reload triggers the next one
+        value = sync.counter.read()
+        if value == sync.seen:
+            return
+        await load_caches(app.state.db)
+        principal_cache.clear()
+        Cereal.write_version += 1
+        sync.seen = value
+        # Listeners cannot be told what another worker changed, only that they must reload
+        Cereal.change_feed.publish_reset()
+
+async def watch_worker_changes(app):
+    # Change feed listeners hear about writes by other workers without waiting for a request
+    while True:
+        await asyncio.sleep(WORKER_SYNC_POLL_SECONDS)
+        if app.state.worker_sync.changed():
+            await reload_caches(app)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled engine per process, shared by every request
+    app.state.db = await DatabaseConnect.connect_from_config()
+    # With several workers only the first one does the setup, the others wait for it
+    app.state.worker_sync = WorkerSync(WORKER_SYNC_DIRECTORY)
+    app.state.reload_lock = asyncio.Lock()
+    with app.state.worker_sync.startup_lock():
+        leader, respawned = app.state.worker_sync.join()
+        if leader:
+            await setup_database(app.state.db, respawned)
+        app.state.worker_sync.mark_joined(leader)
+    app.state.pictures = PictureIndex(PICTURE_DIRECTORY)
+    app.state.picture_cache = Base64Cache(PICTURE_CACHE_BYTES)
+    app.state.response_cache = ResponseCache(RESPONSE_CACHE_BYTES)
+    app.state.picture_variants = VariantStore(PICTURE_VARIANT_DIRECTORY, PICTURE_RESIZE_WORKERS)
+    # Make the common list view sizes in the background, once for all workers
+    warm_task = asyncio.create_task(app.state.picture_variants.warm(app.state.pictures.entries.values(), PICTURE_WARM_WIDTHS)) if leader else None
+    Cereal.query_shapes = QueryShapeRecorder()
+    app.state.index_advisor = IndexAdvisor(app.state.db.engine, Cereal.query_shapes)
+    await load_caches(app.state.db)
+    Cereal.change_feed = ChangeFeed(Cereal, history=app.state.db.config.get('change_feed_history', 1000))
+    Cereal.write_listener = User.write_listener = app.state.worker_sync.notify
+    watch_task = asyncio.create_task(watch_worker_changes(app))
+    registry.add_collector(collect_app_metrics)
+    try:
+        yield
+    finally:
+        registry.remove_collector(collect_app_metrics)
+        watch_task.cancel()
+        if warm_task is not None:
+            warm_task.cancel()
+        await asyncio.to_thread(app.state.picture_variants.close)
+        Cereal.catalog = None
+        Cereal.name_index = None
+        Cereal.similarity_index = None
+        Cereal.change_feed = None
+        Cereal.query_shapes = None
+        Cereal.write_listener = User.write_listener = None
+        app.state.worker_sync.close()
+        await app.state.db.close()
+
+MAX_BATCH_SIZE = 1000
+MAX_IMPORT_ERRORS = 100
+MAX_PICTURE_BUNDLE = 100
+EXPORT_BATCH_SIZE = 1000
+RESPONSE_CACHE_BYTES = 32 * 1024 * 1024
+PICTURE_DIRECTORY = "Cereal Pictures"
+PICTURE_CACHE_BYTES = 16 * 1024 * 1024
+PICTURE_VARIANT_DIRECTORY = ".picture_variants"
+PICTURE_WARM_WIDTHS = (160, 320)
+PICTURE_RESIZE_WORKERS = 2
+WORKER_SYNC_DIRECTORY = ".worker_sync"
+WORKER_SYNC_POLL_SECONDS = 1
+
+app = FastAPI(lifespan=lifespan)
+app.mount("/cereal-pictures", StaticFiles(directory=PICTURE_DIRECTORY), name="cereal-pictures")
+app.mount("/cereal-picture-variants", StaticFiles(directory=PICTURE_VARIANT_DIRECTORY, check_dir=False), name="cereal-picture-variants")
 
 origins = [
     "http://localhost:3000",  # React's default port
@@ -51,15 +219,127 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-DB-Statements", "Server-Timing", "X-Missing-Ids"],
 )
 
-async def get_db():
-    db_connect = await DatabaseConnect.connect_from_config()
-    session = await db_connect.get_new_session()
+# Plain ASGI middlewares: unlike @app.middleware they pass the response through without an
+# extra task and buffer per request, which long lived streams like /cereals/changes need
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        # Streaming responses are timed until their headers are sent
+        http_requests_in_flight.inc()
+        started = time.perf_counter()
+        observed = False
+
+        def observe(status_code):
+            nonlocal observed
+            observed = True
+            http_requests_in_flight.dec()
+            # The route template rather than the path, so ids do not become separate series
+            route = scope.get("route")
+            http_request_duration.observe(time.perf_counter() - started, method=scope["method"], route=route.path if route is not None else "unmatched", status=status_code)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if not observed:
+                observe(500)
+
+class WorkerSyncMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Another worker changed the data since this one last loaded it
+        if scope["type"] == "http" and scope["app"].state.worker_sync.changed():
+            await reload_caches(scope["app"])
+        await self.app(scope, receive, send)
+
+class StatementCountMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        # Makes the number of database round trips per request visible to clients and tests
+        stats = StatementStats()
+        db = scope["app"].state.db
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                if stats.writes and db.replicas:
+                    window = db.config.get('read_your_writes_seconds', 5)
+                    headers.append("set-cookie", f"{READ_PRIMARY_COOKIE}=1; HttpOnly; Max-Age={window}; Path=/; SameSite=lax")
+                headers["X-DB-Statements"] = str(stats.count)
+                headers["Server-Timing"] = f'db;dur={stats.seconds * 1000:.2f};desc="{stats.count} statements"'
+            await send(message)
+
+        token = current_statements.set(stats)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_statements.reset(token)
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Nothing but this check while no profile is running
+        session = request_profiler.session
+        if session is None or session.remaining <= 0 or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        session = request_profiler.claim(scope["method"], scope["path"], route_template(scope))
+        if session is None:
+            return await self.app(scope, receive, send)
+        await request_profiler.profile(session, self.app(scope, receive, send), scope)
+
+def route_template(scope):
+    # e.g. "/cereals/{id}", so profiles can be asked for by the route as declared
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", None)
+    return None
+
+# Added innermost first, so the statement count wraps everything like before
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
+app.add_middleware(WorkerSyncMiddleware)
+app.add_middleware(StatementCountMiddleware)
+
+async def get_db(request: Request):
+    session = await request.app.state.db.get_new_session()
+    try:
+        yield session
+    finally:
+        await session.close()
+
+READ_PRIMARY_COOKIE = "read_primary"
+
+def reads_primary(request: Request):
+    # Set after the client wrote something, so it reads its own writes despite replication lag
+    return READ_PRIMARY_COOKIE in request.cookies
+
+async def get_read_db(request: Request):
+    # For endpoints that only read, routed to a replica when there are any
+    session = await request.app.state.db.get_read_session(primary=reads_primary(request))
     try:
         yield session
     finally:
-        await db_connect.close()
+        await session.close()
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
@@ -78,8 +358,9 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             headers={"WWW-Authenticate": "Bearer"},
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    principal = principal_cache.put(user)
     access_token = create_access_token(
-        data={"sub": user.username, "is_admin": user.is_admin}, expires_delta=access_token_expires
+        data={"sub": principal.username, "is_admin": principal.is_admin, "ver": principal.token_version}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -107,10 +388,16 @@ async def get_current_user(token: str = Depends(oauth2_scheme), session: AsyncSe
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = (await session.execute(select(User).where(User.username == token_data.username))).scalar_one_or_none()
-    if user is None:
+    # Only go to the database when the principal is not cached
+    principal = principal_cache.get(token_data.username)
+    if principal is None:
+        user = (await session.execute(select(User).where(User.username == token_data.username))).scalar_one_or_none()
+        if user is None:
+            raise credentials_exception
+        principal = principal_cache.put(user)
+    if payload.get("ver", 0) != principal.token_version:
         raise credentials_exception
-    return user
+    return principal
 
 async def get_current_admin_user(current_user: User = Depends(get_current_user)):
     if not current_user.is_admin == "True":
@@ -119,69 +406,224 @@ async def get_current_admin_user(current_user: User = Depends(get_current_user))
 
 @app.post("/users/create", response_model=UserResposne)
 async def create_user(user: UserBase, session: AsyncSession = Depends(get_db)):
-    existing_user = await User.check_if_exists(session, field="username", value=user.username)
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Username already exists")
-    existing_user = await User.check_if_exists(session, field="email", value=user.email)
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already exists")
     try:
         result = await User.create_user(session=session, **user.dict())
         return UserResposne.from_orm(result)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/users/create/admin", response_model=UserAdminResponse)
 async def create_admin_user(user: UserAdmin, current_user: User = Depends(get_current_admin_user), session: AsyncSession = Depends(get_db)):
-    existing_user = await User.check_if_exists(session, field="username", value=user.username)
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Username already exists")
-    existing_user = await User.check_if_exists(session, field="email", value=user.email)
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already exists")
     try:
         result = await User.create_user(session=session, **user.dict())
         return UserAdminResponse.from_orm(result)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def variant_params(width, format):
+    format = (format or "jpeg").lower()
+    if format not in VARIANT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Available formats are {', '.join(VARIANT_FORMATS)}.")
+    if width is not None and width <= 0:
+        raise HTTPException(status_code=400, detail="Invalid width. Width must be a positive number.")
+    return snap_width(width or PICTURE_WARM_WIDTHS[-1]), format
+
+def parse_ids(ids, max_ids):
+    # "1,5,9" to [1, 5, 9], duplicates dropped
+    try:
+        result = list(dict.fromkeys(int(id) for id in ids.split(",") if id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma separated list of integers")
+    if not result:
+        raise HTTPException(status_code=400, detail="ids must not be empty")
+    if len(result) > max_ids:
+        raise HTTPException(status_code=400, detail=f"Too many ids, at most {max_ids} are allowed")
+    return result
+
 @app.get("/cereals/{id}/picture")
-async def get_cereal_picture(id: int, response_type: str = "redirect", session: AsyncSession = Depends(get_db)):
+async def get_cereal_picture(request: Request, id: int, response_type: str = "redirect", width: Optional[int] = None, format: Optional[str] = None, session: AsyncSession = Depends(get_read_db)):
     cereal = await Cereal.get_by_id(session, id)
     if cereal is None:
         raise HTTPException(status_code=404, detail="Cereal not found")
 
-    # Remove spaces from the cereal name
-    cereal_name_no_spaces = cereal.name.replace(" ", "")
-
-    # Check all files in the directory
-    for filename in os.listdir("Cereal Pictures"):
-        # Remove spaces from the filename and compare with the cereal name
-        if filename.replace(" ", "").startswith(cereal_name_no_spaces):
-            if response_type.lower() == "base64":
-                with open(f"Cereal Pictures/{filename}", 'rb') as f:
-                    base64image = base64.b64encode(f.read()).decode('utf-8')
-                return {"image": base64image}
-            elif response_type.lower() == "redirect":
-                url_filename = filename.replace(" ", "%20")
-                return RedirectResponse(url=f"/cereal-pictures/{url_filename}")
-            elif response_type.lower() == "file":
-                return FileResponse(path=f"Cereal Pictures/{filename}", filename=filename)
-            else:
-                raise HTTPException(status_code=400, detail="Invalid response_type. Available types are 'base64', 'redirect', and 'file'.")
-
-    raise HTTPException(status_code=404, detail="Cereal picture not found")
+    picture = request.app.state.pictures.lookup(cereal.name)
+    if picture is None:
+        raise HTTPException(status_code=404, detail="Cereal picture not found")
+
+    response_type = response_type.lower()
+    if response_type not in ("base64", "redirect", "file"):
+        raise HTTPException(status_code=400, detail="Invalid response_type. Available types are 'base64', 'redirect', and 'file'.")
+
+    if width is not None or format is not None:
+        width, format = variant_params(width, format)
+        picture = await request.app.state.picture_variants.get(picture, width, format)
+        if response_type == "redirect":
+            return RedirectResponse(url=f"/cereal-picture-variants/{quote(picture.filename)}")
+    elif response_type == "redirect":
+        return RedirectResponse(url=f"/cereal-pictures/{quote(picture.filename)}")
+
+    headers = picture_headers(picture)
+    if is_not_modified(request.headers, picture):
+        return Response(status_code=304, headers=headers)
+
+    if response_type == "base64":
+        base64image = await request.app.state.picture_cache.get(picture)
+        return JSONResponse(content={"image": base64image}, headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+    try:
+        byte_range = parse_range(request.headers, picture)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{picture.size}"})
+    if byte_range is not None:
+        start, end = byte_range
+        content = await asyncio.to_thread(read_range, picture.path, start, end)
+        headers["Content-Range"] = f"bytes {start}-{end}/{picture.size}"
+        return Response(content=content, status_code=206, media_type=mimetypes.guess_type(picture.filename)[0], headers=headers)
+    return FileResponse(path=picture.path, filename=picture.filename, headers=headers)
+
+# Declared before GET /cereals/{field}/{value}, only numeric ids match so a value can still be "similar"
+@app.get("/cereals/{id:int}/similar", response_model=List[CerealSimilarResult])
+async def get_similar_cereals(id: int, k: int = Query(10, ge=1, le=100), include_rating: bool = False, session: AsyncSession = Depends(get_read_db)):
+    fields = NUTRITION_FIELDS + ('rating',) if include_rating else NUTRITION_FIELDS
+    results = await Cereal.similar(session, id, k, fields)
+    return [CerealSimilarResult(**CerealInDB.from_orm(cereal).dict(), distance=distance) for cereal, distance in results]
+
+async def stream_cereals(request: Request, field, order, query, *args, limit=None, **kwargs):
+    # The response outlives get_db, so the stream gets its own session
+    session = await request.app.state.db.get_read_session(primary=reads_primary(request))
+    try:
+        # A page is read whole, so its X-Next-Cursor can be sent before the rows
+        rows = await query(session, *args, limit=limit, stream=limit is None, **kwargs)
+    except BaseException:
+        await session.close()
+        raise
+    response = ndjson_response(rows, CerealInDB, session)
+    response.headers.update(next_cursor_headers(rows, limit, field, order))
+    return response
+
+async def read_for_cache(request: Request, session, query):
+    # A replica may not have the latest write yet, and what it returns is kept until the next
+    # write, so cache misses read from the primary
+    if Cereal.catalog is not None or not request.app.state.db.replicas:
+        return await query(session)
+    primary = await request.app.state.db.get_read_session(primary=True)
+    try:
+        return await query(primary)
+    finally:
+        await primary.close()
+
+async def cached_cereals(request: Request, session, query, limit, field, order):
+    # The encoded body is reused until the next write, by this worker or another one
+    cache = request.app.state.response_cache
+    key = cache.make_key(request)
+    version = Cereal.write_version
+    entry = cache.get(key, version)
+    if entry is None:
+        result = await read_for_cache(request, session, query)
+        body = json.dumps(jsonable_encoder([CerealInDB.from_orm(cereal) for cereal in result]), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        entry = cache.put(key, version, body, next_cursor_headers(result, limit, field, order))
+    return entry.to_response(request)
 
 @app.get("/cereals", response_model=List[CerealInDB])
-async def get_cereals(session: AsyncSession = Depends(get_db)):
-    result = await Cereal.get_all(session)
-    if result:
+async def get_cereals(request: Request, limit: Optional[int] = Query(None, ge=1), cursor: Optional[str] = None, ids: Optional[str] = None, session: AsyncSession = Depends(get_read_db)):
+    if ids is not None:
+        # One IN query for a set of cereals, in the requested order
+        result = await Cereal.get_by_ids(session, parse_ids(ids, MAX_BATCH_SIZE))
         return [CerealInDB.from_orm(cereal) for cereal in result]
-    else:
-        raise HTTPException(status_code=500, detail="Operation failed: Unknown error")
+    after = decode_cursor(cursor, 'id', 'asc')
+    if wants_ndjson(request):
+        return await stream_cereals(request, 'id', 'asc', Cereal.get_all, limit=limit, after=after)
+    return await cached_cereals(request, session, lambda session: Cereal.get_all(session, limit=limit, after=after), limit, 'id', 'asc')
+
+# Declared before GET /cereals/{id} so "search" is not read as an id
+@app.get("/cereals/search", response_model=List[CerealSearchResult])
+async def search_cereals(q: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=100), fuzzy: bool = True, session: AsyncSession = Depends(get_read_db)):
+    results = await Cereal.search(session, q, limit, fuzzy)
+    return [CerealSearchResult(**CerealInDB.from_orm(cereal).dict(), match=match) for cereal, match in results]
+
+STATS_METRICS = ['calories', 'sugars', 'rating']
+
+# Declared before GET /cereals/{id} so "stats" is not read as an id
+@app.get("/cereals/stats")
+async def get_cereal_stats(request: Request, group_by: List[str] = Query([]), metrics: List[str] = Query(STATS_METRICS), bins: int = Query(10, ge=1, le=100), session: AsyncSession = Depends(get_read_db)):
+    # Computed once per write version, the first request after a write recomputes it
+    cache = request.app.state.response_cache
+    key = cache.make_key(request)
+    version = Cereal.write_version
+    entry = cache.get(key, version)
+    if entry is None:
+        result = await read_for_cache(request, session, lambda session: Cereal.get_stats(session, group_by, metrics, bins))
+        body = json.dumps(result, separators=(",", ":")).encode("utf-8")
+        entry = cache.put(key, version, body, {})
+    return entry.to_response(request)
+
+# Declared before GET /cereals/{id} so "changes" is not read as an id
+@app.get("/cereals/changes")
+async def cereal_changes(last_event_id: Optional[str] = Query(None), last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")):
+    # No database session, a listener only waits on the in-process feed
+    # EventSource sends the header when it reconnects, the query parameter resumes a new EventSource
+    return StreamingResponse(
+        Cereal.change_feed.stream(last_event_id_header or last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Declared before GET /cereals/{id} so "pictures" is not read as an id
+@app.get("/cereals/pictures")
+async def get_cereal_pictures(request: Request, ids: str, bundle: str = "zip", width: Optional[int] = None, format: Optional[str] = None, session: AsyncSession = Depends(get_read_db)):
+    bundle = bundle.lower()
+    if bundle not in ("zip", "multipart"):
+        raise HTTPException(status_code=400, detail="Invalid bundle. Available bundles are 'zip' and 'multipart'.")
+    requested = parse_ids(ids, MAX_PICTURE_BUNDLE)
+    cereals = await Cereal.get_by_ids(session, requested)
+    found = [(cereal.id, request.app.state.pictures.lookup(cereal.name)) for cereal in cereals]
+    found = [(id, picture) for id, picture in found if picture is not None]
+    if not found:
+        raise HTTPException(status_code=404, detail="No cereal pictures found")
+    pictures = [picture for _, picture in found]
+    if width is not None or format is not None:
+        # Missing variants are resized side by side in the process pool
+        width, format = variant_params(width, format)
+        pictures = await asyncio.gather(*(request.app.state.picture_variants.get(picture, width, format) for picture in pictures))
+    # Named after the cereal id, so clients can match them up
+    items = [(f"{id}{os.path.splitext(picture.filename)[1]}", picture) for (id, _), picture in zip(found, pictures)]
+    headers = {"Cache-Control": "no-cache"}
+    missing = sorted(set(requested) - {id for id, _ in found})
+    if missing:
+        headers["X-Missing-Ids"] = ",".join(map(str, missing))
+    # Files are read and sent one chunk at a time, the bundle is never held in memory
+    if bundle == "zip":
+        headers["Content-Disposition"] = 'attachment; filename="cereal-pictures.zip"'
+        return StreamingResponse(zip_pictures(items), media_type="application/zip", headers=headers)
+    boundary = secrets.token_hex(16)
+    return StreamingResponse(multipart_pictures(items, boundary), media_type=f"multipart/mixed; boundary={boundary}", headers=headers)
+
+# Declared before GET /cereals/{id} so "export.csv" is not read as an id
+@app.get("/cereals/export.csv")
+async def export_cereals(request: Request, include_id: bool = False, delimiter: str = ';'):
+    fields = (['id'] if include_id else []) + EXPORT_FIELDS
+    table = Cereal.__table__
+    # The response outlives get_db, so the stream gets its own session
+    session = await request.app.state.db.get_read_session(primary=reads_primary(request))
+
+    async def generate():
+        try:
+            yield csv_header(fields, delimiter)
+            result = await session.stream(select(*(table.c[field] for field in fields)).order_by(table.c.id))
+            async for rows in result.partitions(EXPORT_BATCH_SIZE):
+                yield csv_lines(rows, delimiter)
+        finally:
+            await session.close()
+
+    return StreamingResponse(generate(), media_type="text/csv", headers={"Content-Disposition": 'attachment; filename="cereals.csv"'})
 
 @app.get("/cereals/{id}", response_model=CerealInDB)
-async def get_cereal_by_id(id: int, session: AsyncSession = Depends(get_db)):
+async def get_cereal_by_id(id: int, session: AsyncSession = Depends(get_read_db)):
     cereal = await Cereal.get_by_id(session, id)
     if cereal:
         return CerealInDB.from_orm(cereal)
@@ -189,28 +631,36 @@ async def get_cereal_by_id(id: int, session: AsyncSession = Depends(get_db)):
         raise HTTPException(status_code=500, detail="Operation failed: Unknown error")
 
 @app.get("/cereals/sorted/{field}", response_model=List[CerealInDB])
-async def get_cereal_by_field_sorted(field: str, order: Optional[str] = 'asc', session: AsyncSession = Depends(get_db)):
-    result = await Cereal.get_by_field_sorted(session, field, order)
-    if result:
-        return [CerealInDB.from_orm(cereal) for cereal in result]
-    else:
-        raise HTTPException(status_code=500, detail="Operation failed: Unknown error")
+async def get_cereal_by_field_sorted(request: Request, field: str, order: Optional[str] = 'asc', limit: Optional[int] = Query(None, ge=1), cursor: Optional[str] = None, session: AsyncSession = Depends(get_read_db)):
+    after = decode_cursor(cursor, field, order)
+    if wants_ndjson(request):
+        return await stream_cereals(request, field, order, Cereal.get_by_field_sorted, field, order, limit=limit, after=after)
+    return await cached_cereals(request, session, lambda session: Cereal.get_by_field_sorted(session, field, order, limit=limit, after=after), limit, field, order)
 
 @app.get("/cereals/{field}/{value}", response_model=List[CerealInDB])
-async def get_cereal_by_field_value(field: str, value: str, comparison: Optional[str] = 'eq', order: Optional[str] = 'asc', session: AsyncSession = Depends(get_db)):
-    result = await Cereal.get_by_field_value(session, field, value, comparison, order)
-    if result:
-        return [CerealInDB.from_orm(cereal) for cereal in result]
-    else:
-        raise HTTPException(status_code=500, detail="Operation failed: Unknown error")
+async def get_cereal_by_field_value(request: Request, field: str, value: str, comparison: Optional[str] = 'eq', order: Optional[str] = 'asc', limit: Optional[int] = Query(None, ge=1), cursor: Optional[str] = None, session: AsyncSession = Depends(get_read_db)):
+    after = decode_cursor(cursor, field, order)
+    if wants_ndjson(request):
+        return await stream_cereals(request, field, order, Cereal.get_by_field_value, field, value, comparison, order, limit=limit, after=after)
+    return await cached_cereals(request, session, lambda session: Cereal.get_by_field_value(session, field, value, comparison, order, limit=limit, after=after), limit, field, order)
 
 @app.post("/cereals/filter", response_model=List[CerealInDB])
 async def get_cereal_by_filters(
+    request: Request,
+    response: Response,
     filter: FilterExample = Body(...),
-    session: AsyncSession = Depends(get_db)
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    session: AsyncSession = Depends(get_read_db)
 ):
-    result = await Cereal.get_by_filters(session, filter.filters, filter.order)
-    if result:
+    # Filter results are ordered by the first filter field, or by id
+    cursor_field = next(iter(filter.filters), 'id') if filter.order in ('asc', 'desc') else 'id'
+    after = decode_cursor(cursor, cursor_field, filter.order)
+    if wants_ndjson(request):
+        return await stream_cereals(request, cursor_field, filter.order, Cereal.get_by_filters, filter.filters, filter.order, limit=limit, after=after)
+    result = await Cereal.get_by_filters(session, filter.filters, filter.order, limit=limit, after=after)
+    if result or after is not None:
+        response.headers.update(next_cursor_headers(result, limit, cursor_field, filter.order))
         return [CerealInDB.from_orm(cereal) for cereal in result]
     else:
         raise HTTPException(status_code=500, detail="Operation failed: Unknown error")
@@ -223,13 +673,114 @@ async def upsert_cereal(cereal: CerealBase, current_user: User = Depends(get_cur
     else:
         raise HTTPException(status_code=500, detail="Operation failed: Unknown error")
     
+@app.post("/cereals/batch", response_model=List[BatchItemResult])
+async def upsert_cereals_batch(cereals: List[CerealBatchItem], current_user: User = Depends(get_current_admin_user), session: AsyncSession = Depends(get_db)):
+    if len(cereals) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch too large, at most {MAX_BATCH_SIZE} items are allowed")
+    return await Cereal.bulk_upsert(session, [cereal.dict() for cereal in cereals])
+
+@app.post("/cereals/import", response_model=ImportResult)
+async def import_cereals(file: UploadFile, delimiter: str = ';', current_user: User = Depends(get_current_admin_user), session: AsyncSession = Depends(get_db)):
+    # The upload is spooled to disk and read back in chunks, each chunk is one transaction
+    summary = ImportResult()
+    try:
+        reader = CerealCsvReader(file.file, delimiter)
+        while True:
+            rows = await asyncio.to_thread(reader.read_chunk, MAX_BATCH_SIZE)
+            if not rows:
+                break
+            valid = [(line, item) for line, item, error in rows if error is None]
+            failed = [(line, error) for line, item, error in rows if error is not None]
+            try:
+                results = await Cereal.bulk_upsert(session=session, items=[item for line, item in valid]) if valid else []
+            except HTTPException as e:
+                # e.g. a name another request saved in the meantime, the chunk was rolled back
+                if e.status_code >= 500:
+                    raise
+                results = [{"status": "error", "detail": e.detail}] * len(valid)
+            for (line, item), result in zip(valid, results):
+                if result["status"] in ("created", "updated"):
+                    setattr(summary, result["status"], getattr(summary, result["status"]) + 1)
+                else:
+                    failed.append((line, result["detail"]))
+            summary.failed += len(failed)
+            for line, detail in sorted(failed):
+                if len(summary.errors) < MAX_IMPORT_ERRORS:
+                    summary.errors.append(ImportErrorItem(line=line, detail=detail))
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="The file must be UTF-8 encoded CSV")
+    return summary
+
+# Declared before DELETE /cereals/{id} so "batch" is not read as an id
+@app.delete("/cereals/batch", response_model=List[BatchItemResult])
+async def delete_cereals_batch(ids: List[int] = Body(...), current_user: User = Depends(get_current_admin_user), session: AsyncSession = Depends(get_db)):
+    if len(ids) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch too large, at most {MAX_BATCH_SIZE} items are allowed")
+    return await Cereal.bulk_delete(session, ids)
+
 @app.delete("/cereals/{id}")
 async def delete_cereal(id: int, current_user: User = Depends(get_current_admin_user), session: AsyncSession = Depends(get_db)):
     await Cereal.delete(session, id)
     return {"message": f"Cereal with id {id} deleted successfully"}
 
-db_utils = DatabaseUtils()
-db_utils.setup_db()
+@app.post("/users/{username}/revoke")
+async def revoke_user_tokens(username: str, current_user: User = Depends(get_current_admin_user), session: AsyncSession = Depends(get_db)):
+    # Stored and cached lowercase, see User.validate_username
+    username = username.lower()
+    await User.revoke_tokens(session, username)
+    principal_cache.revoke(username)
+    return {"message": f"Tokens for user {username} revoked successfully"}
+
+@app.get("/db/pool")
+async def get_db_pool_status(request: Request, current_user: User = Depends(get_current_admin_user)):
+    return request.app.state.db.pool_status()
+
+@app.get("/db/query-shapes")
+async def get_query_shapes(top: Optional[int] = Query(None, ge=1), current_user: User = Depends(get_current_admin_user)):
+    return Cereal.query_shapes.stats(top)
+
+@app.delete("/db/query-shapes")
+async def reset_query_shapes(current_user: User = Depends(get_current_admin_user)):
+    Cereal.query_shapes.reset()
+    return {"message": "Query shapes reset"}
+
+@app.get("/db/index-advice")
+async def get_index_advice(request: Request, top: int = Query(5, ge=1, le=50), current_user: User = Depends(get_current_admin_user)):
+    return jsonable_encoder(await request.app.state.index_advisor.advise([Cereal], top))
+
+@app.post("/db/index-advice")
+async def apply_index_advice(request: Request, top: int = Query(5, ge=1, le=50), current_user: User = Depends(get_current_admin_user)):
+    # Creates the proposed indexes that do not exist yet
+    return jsonable_encoder(await request.app.state.index_advisor.advise([Cereal], top, apply=True))
+
+@app.post("/debug/profile")
+async def start_profile(route: str, count: int = Query(10, ge=1, le=1000), mode: str = 'sample', method: Optional[str] = None, interval_ms: float = Query(1.0, ge=0.1, le=100), current_user: User = Depends(get_current_admin_user)):
+    # Profiles the next count requests in this worker process whose path or route matches
+    if mode not in PROFILE_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid mode. Available modes are {', '.join(PROFILE_MODES)}.")
+    request_profiler.start(route, count, mode, method, interval_ms / 1000)
+    return request_profiler.status()
+
+@app.get("/debug/profile")
+async def get_profile(format: str = 'text', top: int = Query(30, ge=1), current_user: User = Depends(get_current_admin_user)):
+    if format == 'collapsed':
+        return PlainTextResponse(request_profiler.collapsed())
+    if format == 'text':
+        return PlainTextResponse(request_profiler.text(top))
+    if format == 'status':
+        return request_profiler.status()
+    raise HTTPException(status_code=400, detail="Invalid format. Available formats are 'text', 'collapsed' and 'status'.")
+
+@app.delete("/debug/profile")
+async def stop_profile(current_user: User = Depends(get_current_admin_user)):
+    request_profiler.stop()
+    return request_profiler.status()
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    if METRICS_TOKEN is not None and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(registry.render(), media_type=CONTENT_TYPE)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="localhost", port=8000)
\ No newline at end of file
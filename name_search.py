@@ -0,0 +1,164 @@
+from collections import Counter, deque
+from sqlalchemy.future import select
+
+def normalize_name(name):
+    # Names are matched regardless of spacing and casing
+    return name.replace(" ", "").casefold()
+
+def trigrams(key):
+    # Padded at the start so short names and first letters still produce grams
+    padded = f"$${key}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class PrefixTrie:
+    """Set of values per key, with keys under a prefix listed shortest and then alphabetical first."""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, key, value):
+        node = self.root
+        for char in key:
+            node = node.setdefault(char, {})
+        node.setdefault(None, set()).add(value)
+
+    def discard(self, key, value):
+        path = [self.root]
+        for char in key:
+            node = path[-1].get(char)
+            if node is None:
+                return
+            path.append(node)
+        values = path[-1].get(None)
+        if values is None:
+            return
+        values.discard(value)
+        if not values:
+            del path[-1][None]
+        # Drop nodes that no longer lead to any key
+        for depth in range(len(key), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][key[depth - 1]]
+
+    def get(self, key):
+        node = self.root
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                return set()
+        return node.get(None, set())
+
+    def with_prefix(self, prefix):
+        # Breadth first, so the generator can be stopped after the first matches
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return
+        queue = deque([(prefix, node)])
+        while queue:
+            key, node = queue.popleft()
+            if None in node:
+                yield key, node[None]
+            for char in sorted(char for char in node if char is not None):
+                queue.append((key + char, node[char]))
+
+class NameIndex:
+    """In-memory search over one text column of a model, updated together with the table.
+
+    Prefix matches come from a trie, substring and typo tolerant matches from a trigram index.
+    """
+
+    def __init__(self, model, field='name', min_similarity=0.3):
+        self.model = model
+        self.field = field
+        self.min_similarity = min_similarity
+        self.keys = {}
+        self.trie = PrefixTrie()
+        self.grams = {}
+
+    async def load(self, session):
+        column = getattr(self.model, self.field)
+        result = await session.execute(select(self.model.id, column))
+        for id, name in result:
+            self.add(id, name)
+
+    def add(self, id, name):
+        self.discard(id)
+        key = normalize_name(name)
+        self.keys[id] = key
+        self.trie.add(key, id)
+        for gram in trigrams(key):
+            self.grams.setdefault(gram, set()).add(id)
+
+    def discard(self, id):
+        key = self.keys.pop(id, None)
+        if key is None:
+            return
+        self.trie.discard(key, id)
+        for gram in trigrams(key):
+            ids = self.grams.get(gram)
+            if ids is not None:
+                ids.discard(id)
+                if not ids:
+                    del self.grams[gram]
+
+    def put_many(self, rows):
+        for row in rows:
+            name = getattr(row, self.field)
+            if name is not None:
+                self.add(row.id, name)
+
+    def remove_many(self, ids):
+        for id in ids:
+            self.discard(id)
+
+    def search(self, query, limit=10, fuzzy=True):
+        """Return up to limit (id, match) pairs, match is exact, prefix, substring or fuzzy."""
+        query = normalize_name(query)
+        if not query:
+            return []
+        results = {}
+        for id in sorted(self.trie.get(query)):
+            results[id] = 'exact'
+        for key, ids in self.trie.with_prefix(query):
+            if len(results) >= limit:
+                break
+            for id in sorted(ids):
+                results.setdefault(id, 'prefix')
+        if len(results) < limit:
+            results.update((id, 'substring') for id in self.substrings(query, limit - len(results), results))
+        if fuzzy and len(results) < limit:
+            results.update((id, 'fuzzy') for id in self.similar(query, limit - len(results), results))
+        return list(results.items())[:limit]
+
+    def substrings(self, query, limit, skip):
+        if len(query) < 3:
+            # Too short for trigrams, the name has to be scanned
+            candidates = self.keys
+        else:
+            # Every unpadded trigram of the query has to occur in the name
+            postings = sorted((self.grams.get(query[i:i + 3], set()) for i in range(len(query) - 2)), key=len)
+            candidates = set.intersection(*postings)
+        # Earlier occurrences first, then shorter names
+        found = sorted(
+            (self.keys[id].find(query), len(self.keys[id]), self.keys[id], id)
+            for id in candidates if id not in skip and query in self.keys[id]
+        )
+        return [id for *_, id in found[:limit]]
+
+    def similar(self, query, limit, skip):
+        query_grams = trigrams(query)
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self.grams.get(gram, ()))
+        scored = []
+        for id, count in shared.items():
+            if id in skip:
+                continue
+            similarity = count / (len(query_grams) + len(trigrams(self.keys[id])) - count)
+            if similarity >= self.min_similarity:
+                scored.append((-similarity, self.keys[id], id))
+        scored.sort()
+        return [id for *_, id in scored[:limit]]
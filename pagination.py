@@ -0,0 +1,66 @@
+import json
+import base64
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def encode_cursor(field, order, row):
+    # Opaque to clients: the sort field, direction and the (value, id) of the last row
+    payload = json.dumps([field, order, getattr(row, field), row.id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, field, order):
+    if cursor is None:
+        return None
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_field, cursor_order, value, last_id = json.loads(payload)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_field != field or cursor_order != order:
+        raise HTTPException(status_code=400, detail="Cursor does not belong to this query")
+    return value, last_id
+
+class Page(list):
+    """The rows of one page, more tells whether rows follow it."""
+
+    def __init__(self, rows=(), more=False):
+        super().__init__(rows)
+        self.more = more
+
+def peek_limit(limit):
+    # One row past the page, only read to know whether there is a next page
+    return None if limit is None else limit + 1
+
+def page(rows, limit):
+    # rows were read with peek_limit(limit), without a limit they are all there is
+    if limit is None:
+        return rows
+    rows = list(rows)
+    return Page(rows[:limit], len(rows) > limit)
+
+def next_cursor_headers(results, limit, field, order):
+    if limit is None or not getattr(results, 'more', False):
+        return {}
+    return {"X-Next-Cursor": encode_cursor(field, order, results[-1])}
+
+def wants_ndjson(request):
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+async def iterate(rows):
+    if hasattr(rows, '__aiter__'):
+        async for row in rows:
+            yield row
+    else:
+        for row in rows:
+            yield row
+
+def ndjson_response(rows, model, session):
+    async def generate():
+        try:
+            async for row in iterate(rows):
+                yield model.from_orm(row).json() + "\n"
+        finally:
+            await session.close()
+    return StreamingResponse(generate(), media_type=NDJSON_MEDIA_TYPE)
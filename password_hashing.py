@@ -0,0 +1,57 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_HASH_METHOD = "scrypt:32768:8:1"
+
+class PasswordHasher:
+    """Runs password hashing on a small thread pool so logins do not block the event loop.
+
+    hashlib releases the GIL while hashing. When more than workers + max_queue
+    operations are waiting, new ones are rejected with a 503 instead of piling up.
+    """
+
+    def __init__(self, method=DEFAULT_HASH_METHOD, workers=2, max_queue=16):
+        self.executor = None
+        self.configure(method, workers, max_queue)
+
+    def configure(self, method=DEFAULT_HASH_METHOD, workers=2, max_queue=16):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.method = method
+        # Both made on first use, importing or configuring costs no hashing and no threads
+        self.stored_method = None
+        self.executor = None
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self.rejected = 0
+
+    async def run(self, func, *args):
+        if self.pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Too many login attempts in progress, try again later", headers={"Retry-After": "1"})
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password):
+        return await self.run(generate_password_hash, password, self.method)
+
+    async def verify(self, pwhash, password):
+        return await self.run(check_password_hash, pwhash, password)
+
+    async def needs_rehash(self, pwhash):
+        if self.stored_method is None:
+            # Werkzeug stores shorthand methods with their defaults filled in, e.g. "scrypt" as
+            # "scrypt:32768:8:1", so the prefix to compare with comes from a real hash
+            self.stored_method = (await self.hash("")).split("$", 1)[0]
+        # Werkzeug hashes are stored as method$salt$hash
+        return pwhash.split("$", 1)[0] != self.stored_method
+
+password_hasher = PasswordHasher()
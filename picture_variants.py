@@ -0,0 +1,90 @@
+import os
+import asyncio
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from pictures import PictureEntry
+
+# Requested widths are rounded up to one of these, so the cache stays bounded
+VARIANT_WIDTHS = (80, 160, 320, 640, 1024)
+VARIANT_FORMATS = {
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp'),
+    'png': ('PNG', 'png'),
+}
+
+def snap_width(width):
+    for allowed in VARIANT_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return VARIANT_WIDTHS[-1]
+
+def resize_picture(source, target, width, format):
+    # Runs in a worker process
+    pil_format = VARIANT_FORMATS[format][0]
+    with Image.open(source) as image:
+        image.thumbnail((width, width * 4))
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        temp = f"{target}.{os.getpid()}.tmp"
+        image.save(temp, pil_format, optimize=True, quality=85)
+    os.replace(temp, target)
+    return target
+
+class VariantStore:
+    """Resized copies of the cereal pictures, made in a process pool and kept on disk."""
+
+    def __init__(self, directory, max_workers=2):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Every worker process has its own pool, so it is kept small
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.pending = {}
+
+    def source_key(self, entry):
+        # The source mtime and size are part of the name, a changed picture gets new variants
+        name_hash = hashlib.sha1(entry.filename.encode('utf-8')).hexdigest()[:16]
+        return f"{name_hash}-{int(entry.mtime * 1000000):x}-{entry.size:x}"
+
+    def variant_filename(self, entry, width, format):
+        return f"{self.source_key(entry)}-{width}.{VARIANT_FORMATS[format][1]}"
+
+    def to_entry(self, filename):
+        path = os.path.join(self.directory, filename)
+        stat = os.stat(path)
+        return PictureEntry(filename, path, stat.st_size, stat.st_mtime)
+
+    async def get(self, entry, width, format):
+        filename = self.variant_filename(entry, width, format)
+        path = os.path.join(self.directory, filename)
+        if not os.path.exists(path):
+            # Concurrent requests for the same variant share one resize job
+            future = self.pending.get(filename)
+            if future is None:
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(self.executor, resize_picture, entry.path, path, width, format)
+                self.pending[filename] = future
+                future.add_done_callback(lambda _: self.pending.pop(filename, None))
+            await future
+        return self.to_entry(filename)
+
+    async def warm(self, entries, widths, format='jpeg'):
+        entries = list(entries)
+        self.prune(entries)
+        jobs = [self.get(entry, width, format) for entry in entries for width in widths]
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        return sum(1 for result in results if not isinstance(result, Exception))
+
+    def prune(self, entries):
+        # Remove variants of pictures that were changed or deleted
+        valid = {self.source_key(entry) for entry in entries}
+        for filename in os.listdir(self.directory):
+            if filename.rsplit('-', 1)[0] not in valid:
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+
+    def close(self):
+        # Queued resizes are dropped, running ones finish so no file is written after shutdown
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,247 @@
+import os
+import time
+import base64
+import asyncio
+import threading
+import mimetypes
+import zipfile
+from collections import namedtuple, OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from name_search import normalize_name, PrefixTrie
+
+PictureEntry = namedtuple('PictureEntry', ['filename', 'path', 'size', 'mtime'])
+
+class PictureIndex:
+    """Maps cereal names to picture files, built once and refreshed when the directory changes."""
+
+    def __init__(self, directory, check_interval=2.0):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.by_stem = {}
+        self.stems = PrefixTrie()
+        self.matches = {}
+        self.dir_mtime = None
+        self.last_check = 0.0
+        self.refresh()
+
+    def refresh(self):
+        with self.lock:
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+            entries = {}
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    if not item.is_file():
+                        continue
+                    stat = item.stat()
+                    old = self.entries.get(item.name)
+                    # Keep unchanged entries, only new or modified files get a new entry
+                    if old is not None and old.size == stat.st_size and old.mtime == stat.st_mtime:
+                        entries[item.name] = old
+                    else:
+                        entries[item.name] = PictureEntry(item.name, os.path.join(self.directory, item.name), stat.st_size, stat.st_mtime)
+            # Pictures are named after the cereal, but spacing and casing are not consistent
+            by_stem = {}
+            stems = PrefixTrie()
+            for filename in sorted(entries):
+                stem = normalize_name(os.path.splitext(filename)[0])
+                by_stem.setdefault(stem, entries[filename])
+                stems.add(stem, stem)
+            self.entries = entries
+            self.by_stem = by_stem
+            self.stems = stems
+            self.matches = {}
+            self.dir_mtime = dir_mtime
+            self.last_check = time.monotonic()
+
+    def check(self):
+        now = time.monotonic()
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if dir_mtime != self.dir_mtime:
+            self.refresh()
+
+    def resolve(self, name):
+        key = normalize_name(name)
+        entry = self.by_stem.get(key)
+        if entry is not None:
+            return entry
+        # Fall back to the closest file starting with the name, shortest and then alphabetical first
+        for stem, _ in self.stems.with_prefix(key):
+            return self.by_stem[stem]
+        return None
+
+    def lookup(self, name):
+        self.check()
+        matches = self.matches
+        if name not in matches:
+            matches[name] = self.resolve(name)
+        return matches[name]
+
+def entity_tag(entry):
+    return f'"{entry.size:x}-{int(entry.mtime * 1000000):x}"'
+
+def picture_headers(entry):
+    return {
+        "ETag": entity_tag(entry),
+        "Last-Modified": formatdate(entry.mtime, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+
+def is_not_modified(request_headers, entry):
+    # If-None-Match takes precedence over If-Modified-Since
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        etag = entity_tag(entry)
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(entry.mtime) <= since
+    return False
+
+def parse_range(request_headers, entry):
+    """Return (start, end) for a single satisfiable byte range, or None to send the whole file.
+
+    Raises ValueError when the range cannot be satisfied.
+    """
+    header = request_headers.get("range")
+    if not header or not header.startswith("bytes="):
+        return None
+    if_range = request_headers.get("if-range")
+    if if_range is not None and if_range.strip() != entity_tag(entry):
+        return None
+    ranges = header[len("bytes="):].split(",")
+    if len(ranges) != 1:
+        # Multiple ranges are allowed to be answered with the full representation
+        return None
+    start, _, end = ranges[0].strip().partition("-")
+    size = entry.size
+    try:
+        if start == "":
+            length = int(end)
+            if length <= 0:
+                raise ValueError("Unsatisfiable range")
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        raise ValueError("Invalid range")
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range")
+    return start, min(end, size - 1)
+
+def read_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start + 1)
+
+async def read_chunks(path, chunk_size=64 * 1024):
+    with open(path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+class ChunkBuffer:
+    """Write target of a streamed ZipFile, emptied after every chunk that is sent on."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+async def zip_pictures(items):
+    """Yield a zip archive of (name, PictureEntry) items, one file chunk at a time.
+
+    The output is not seekable, so sizes and checksums follow each file. Pictures are
+    already compressed and are stored as they are.
+    """
+    buffer = ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for name, entry in items:
+            info = zipfile.ZipInfo(name, date_time=time.localtime(entry.mtime)[:6])
+            info.file_size = entry.size
+            with archive.open(info, "w") as member:
+                async for chunk in read_chunks(entry.path):
+                    member.write(chunk)
+                    yield buffer.take()
+    # The central directory
+    yield buffer.take()
+
+async def multipart_pictures(items, boundary):
+    # multipart/mixed body of (name, PictureEntry) items, one file chunk at a time
+    for name, entry in items:
+        headers = (
+            f"--{boundary}\r\n"
+            f"Content-Type: {mimetypes.guess_type(entry.filename)[0] or 'application/octet-stream'}\r\n"
+            f"Content-Disposition: attachment; filename=\"{name}\"\r\n"
+            f"Content-Length: {entry.size}\r\n\r\n"
+        )
+        yield headers.encode("utf-8")
+        async for chunk in read_chunks(entry.path):
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode("utf-8")
+
+def encode_file(path):
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
+
+class Base64Cache:
+    """LRU cache of base64 encoded pictures, bounded by the total size of the encoded strings."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, entry):
+        # Size and mtime are part of the key so a changed file is never served stale
+        key = (entry.path, entry.size, entry.mtime)
+        value = self.items.get(key)
+        if value is not None:
+            self.hits += 1
+            self.items.move_to_end(key)
+            return value
+        self.misses += 1
+        value = await asyncio.to_thread(encode_file, entry.path)
+        if len(value) <= self.max_bytes and key not in self.items:
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+        return value
+
+    def stats(self):
+        return {
+            "entries": len(self.items),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
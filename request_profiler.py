@@ -0,0 +1,275 @@
+import os
+import sys
+import time
+import fnmatch
+import threading
+from collections import Counter
+
+PROFILE_MODES = ('sample', 'trace')
+
+def frame_key(code):
+    # file:function, the way flamegraph tools show a frame, co_qualname is new in Python 3.11
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}".replace(" ", "_").replace(";", "_")
+
+def suspended_stack(coro):
+    # The frames a suspended coroutine waits in, outermost first, ending with what it awaits
+    keys = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        keys.append(frame_key(frame.f_code))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    keys.append(f"[await {type(coro).__name__}]")
+    return tuple(keys)
+
+class ProfiledRequest:
+    """Wraps the coroutine of one request, so only its own steps are profiled.
+
+    Other requests run in between the steps on the same event loop, and are left out.
+    The time between steps is counted against the stack the request was suspended in,
+    e.g. waiting for the database driver or the password hashing threads.
+    """
+
+    def __init__(self, session, coro):
+        self.session = session
+        self.coro = coro
+        self.stacks = Counter()
+        self.started = time.perf_counter()
+        self.suspended = None
+        self.suspended_at = None
+        self.trace = []
+        self.entry = None
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.step(self.coro.send, None)
+
+    def send(self, value):
+        return self.step(self.coro.send, value)
+
+    def throw(self, *args):
+        return self.step(self.coro.throw, *args)
+
+    def close(self):
+        self.coro.close()
+
+    def step(self, method, *args):
+        session = self.session
+        now = time.perf_counter()
+        if self.suspended is not None and session.mode == 'trace':
+            self.add(self.suspended, now - self.suspended_at)
+        self.suspended = None
+        session.running = self
+        try:
+            if session.mode == 'trace':
+                self.trace = []
+                self.entry = method
+                sys.setprofile(self.trace_event)
+                try:
+                    return method(*args)
+                finally:
+                    sys.setprofile(None)
+            return method(*args)
+        finally:
+            session.running = None
+            # Done once the coroutine has no frame left
+            if self.coro.cr_frame is not None:
+                self.suspended = suspended_stack(self.coro)
+                self.suspended_at = time.perf_counter()
+
+    def trace_event(self, frame, event, arg):
+        # Each entry is [stack, started, time spent in calls made from it, frame or C function]
+        now = time.perf_counter()
+        if arg is self.entry:
+            # The send or throw that resumes the request, not part of it
+            return
+        if event == 'call' or event == 'c_call':
+            if event == 'c_call':
+                key = f"{getattr(arg, '__module__', None) or 'builtins'}:{getattr(arg, '__qualname__', repr(arg))}"
+            else:
+                key = frame_key(frame.f_code)
+            parent = self.trace[-1][0] if self.trace else ()
+            self.trace.append([parent + (key,), now, 0.0, arg if event == 'c_call' else frame])
+        elif event in ('return', 'c_return', 'c_exception'):
+            # Greenlet switches (SQLAlchemy's async bridge) skip events, so a return is matched
+            # to its call, and calls that never got their return are closed with it
+            owner = frame if event == 'return' else arg
+            if not any(entry[3] is owner for entry in reversed(self.trace)):
+                return
+            while True:
+                stack, started, children, entry_owner = self.trace.pop()
+                elapsed = now - started
+                # Only the event loop thread writes in trace mode, no lock needed
+                self.stacks[stack] += elapsed - children
+                if self.trace:
+                    self.trace[-1][2] += elapsed
+                if entry_owner is owner:
+                    break
+
+    def add(self, stack, seconds):
+        if stack:
+            with self.session.lock:
+                self.stacks[stack] += seconds
+
+class ProfileSession:
+    def __init__(self, pattern, method, count, mode, interval):
+        self.pattern = pattern
+        self.method = method
+        self.count = count
+        self.remaining = count
+        self.mode = mode
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.durations = []
+        self.in_flight = set()
+        self.running = None
+        self.started = time.time()
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def matches(self, method, path, route):
+        if self.method is not None and method != self.method:
+            return False
+        return fnmatch.fnmatchcase(path, self.pattern) or route == self.pattern
+
+    @property
+    def done(self):
+        return self.stopped.is_set() or (self.remaining == 0 and not self.in_flight)
+
+class RequestProfiler:
+    """Profiles the next N requests that match a route pattern, on demand.
+
+    Stacks are aggregated by wall time across the profiled requests, and can be read as a
+    text summary or in the collapsed stack format of flamegraph.pl and speedscope. While
+    no profile is running, the only cost is one attribute check per request.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.loop_thread = None
+
+    def start(self, pattern, count=10, mode='sample', method=None, interval=0.001):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Invalid mode, available modes are {', '.join(PROFILE_MODES)}")
+        self.stop()
+        session = ProfileSession(pattern, method.upper() if method else None, count, mode, interval)
+        self.loop_thread = threading.get_ident()
+        if mode == 'sample':
+            session.sampler = threading.Thread(target=self.sample, args=(session,), name="request-profiler", daemon=True)
+            session.sampler.start()
+        self.session = session
+        return session
+
+    def stop(self):
+        session = self.session
+        if session is not None:
+            session.remaining = 0
+            session.stopped.set()
+
+    def claim(self, method, path, route):
+        # The session a new request should be profiled in, or None
+        session = self.session
+        if session is None or session.remaining <= 0 or not session.matches(method, path, route):
+            return None
+        session.remaining -= 1
+        return session
+
+    async def profile(self, session, coro, scope):
+        request = ProfiledRequest(session, coro)
+        session.in_flight.add(request)
+        try:
+            return await request
+        finally:
+            session.in_flight.discard(request)
+            # The router has set the matched route by now
+            route = scope.get("route")
+            label = f"{scope['method']} {route.path if route is not None else scope['path']}"
+            with session.lock:
+                for stack, seconds in request.stacks.items():
+                    session.stacks[(label,) + stack] += seconds
+                session.durations.append(time.perf_counter() - request.started)
+            if session.done:
+                session.stopped.set()
+
+    def sample(self, session):
+        # Runs in its own thread, every interval each profiled request is either running
+        # on the event loop thread or suspended in a known stack
+        step_code = ProfiledRequest.step.__code__
+        last = time.perf_counter()
+        while not session.stopped.wait(session.interval):
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+            running = session.running
+            for request in list(session.in_flight):
+                if request is running:
+                    frame = sys._current_frames().get(self.loop_thread)
+                    stack = []
+                    while frame is not None and frame.f_code is not step_code:
+                        stack.append(frame_key(frame.f_code))
+                        frame = frame.f_back
+                    # Without the step frame the request has just been suspended
+                    stack = tuple(reversed(stack)) if frame is not None else request.suspended
+                else:
+                    stack = request.suspended
+                if stack:
+                    request.add(stack, elapsed)
+
+    def status(self):
+        session = self.session
+        if session is None:
+            return {"state": "idle"}
+        return {
+            "state": "done" if session.done else "running",
+            "pattern": session.pattern,
+            "method": session.method,
+            "mode": session.mode,
+            "count": session.count,
+            "profiled": len(session.durations),
+            "in_flight": len(session.in_flight),
+        }
+
+    def collapsed(self):
+        # One "frame;frame;frame microseconds" line per stack
+        session = self.session
+        if session is None:
+            return ""
+        with session.lock:
+            stacks = list(session.stacks.items())
+        lines = [f"{';'.join(stack)} {round(seconds * 1000000)}" for stack, seconds in sorted(stacks) if seconds > 0]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def text(self, top=30):
+        session = self.session
+        if session is None:
+            return "No profile has been started\n"
+        with session.lock:
+            stacks = list(session.stacks.items())
+            durations = sorted(session.durations)
+        own = Counter()
+        total = Counter()
+        for stack, seconds in stacks:
+            # Waiting is shown with the frame that waits, e.g. the database driver
+            own[f"{stack[-1]} in {stack[-2]}" if stack[-1].startswith("[await") else stack[-1]] += seconds
+            # A frame that recurses is counted once per stack
+            for key in set(stack[1:]):
+                total[key] += seconds
+        status = self.status()
+        lines = [f"{status['state']}: {len(durations)} of {session.count} requests matching {session.method or '*'} {session.pattern}, {session.mode} mode"]
+        if durations:
+            lines.append(f"request time ms: mean {sum(durations) / len(durations) * 1000:.2f}, p50 {durations[len(durations) // 2] * 1000:.2f}, max {durations[-1] * 1000:.2f}")
+        for title, counter in (("self", own), ("total", total)):
+            lines.append("")
+            lines.append(f"{'ms':>10} {'%':>6}  top frames by {title} time")
+            overall = sum(own.values()) or 1
+            for key, seconds in counter.most_common(top):
+                lines.append(f"{seconds * 1000:>10.2f} {seconds / overall * 100:>6.1f}  {key}")
+        return "\n".join(lines) + "\n"
+
+request_profiler = RequestProfiler()
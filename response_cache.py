@@ -0,0 +1,88 @@
+import gzip
+import hashlib
+from collections import OrderedDict
+from fastapi.responses import Response
+
+GZIP_MIN_SIZE = 1024
+
+class CachedBody:
+    __slots__ = ('body', 'gzip_body', 'etag', 'headers')
+
+    def __init__(self, body, etag, headers):
+        self.body = body
+        self.gzip_body = None
+        self.etag = etag
+        self.headers = headers
+
+    def to_response(self, request):
+        headers = {**self.headers, "ETag": self.etag, "Vary": "Accept-Encoding"}
+        if request.headers.get("if-none-match") == self.etag:
+            return Response(status_code=304, headers=headers)
+        body = self.body
+        if len(body) >= GZIP_MIN_SIZE and "gzip" in request.headers.get("accept-encoding", ""):
+            # Compressed once, on the first request that accepts it
+            if self.gzip_body is None:
+                self.gzip_body = gzip.compress(body, compresslevel=6)
+            body = self.gzip_body
+            headers["Content-Encoding"] = "gzip"
+        return Response(content=body, media_type="application/json", headers=headers)
+
+class ResponseCache:
+    """Encoded JSON bodies for read endpoints, valid for one write version.
+
+    Entries are keyed by path and query string. The first lookup after the write
+    version changed drops every entry, so writes invalidate the cache implicitly.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(request):
+        return (request.url.path, tuple(sorted(request.query_params.multi_items())))
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+
+    def get(self, key, version):
+        if version != self.version:
+            self.clear()
+            self.version = version
+        entry = self.items.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return entry
+
+    def put(self, key, version, body, headers):
+        etag = f'"{version}-{hashlib.sha1(body).hexdigest()[:16]}"'
+        entry = CachedBody(body, etag, headers)
+        if version != self.version or len(body) > self.max_bytes:
+            return entry
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= len(old.body)
+        self.items[key] = entry
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= len(evicted.body)
+        return entry
+
+    def stats(self):
+        return {
+            "entries": len(self.items),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,117 @@
+import heapq
+from itertools import chain
+import numpy as np
+from sqlalchemy.future import select
+
+NUTRITION_FIELDS = ('calories', 'protein', 'fat', 'sodium', 'fiber', 'carbo', 'sugars', 'potass', 'vitamins')
+
+class SimilarityIndex:
+    """Numeric feature matrix of a model for nearest neighbour queries, updated in place on writes.
+
+    Distances are Euclidean over standardized columns. The mean cancels out of a difference, so
+    only the per-column standard deviation is needed, kept up to date from running sums.
+    """
+
+    def __init__(self, model, fields=NUTRITION_FIELDS + ('rating',), batch_size=65536):
+        self.model = model
+        self.fields = tuple(fields)
+        self.batch_size = batch_size
+        self.matrix = np.empty((0, len(self.fields)), dtype=np.float64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.size = 0
+        self.positions = {}
+        self.sums = np.zeros(len(self.fields))
+        self.squares = np.zeros(len(self.fields))
+
+    async def load(self, session):
+        table = self.model.__table__
+        result = await session.execute(select(table.c.id, *(table.c[field] for field in self.fields)))
+        rows = result.all()
+        # Flat iteration is much faster than letting numpy inspect each row object
+        data = np.fromiter(chain.from_iterable(rows), dtype=np.float64, count=len(rows) * (len(self.fields) + 1))
+        data = data.reshape(len(rows), len(self.fields) + 1)
+        self.matrix = np.ascontiguousarray(data[:, 1:])
+        self.ids = data[:, 0].astype(np.int64)
+        self.size = len(data)
+        self.positions = {id: position for position, id in enumerate(self.ids.tolist())}
+        self.sums = self.matrix.sum(axis=0)
+        self.squares = (self.matrix ** 2).sum(axis=0)
+
+    def grow(self, needed):
+        if needed <= len(self.ids):
+            return
+        capacity = max(needed, len(self.ids) * 2, 64)
+        matrix = np.empty((capacity, len(self.fields)), dtype=np.float64)
+        matrix[:self.size] = self.matrix[:self.size]
+        ids = np.empty(capacity, dtype=np.int64)
+        ids[:self.size] = self.ids[:self.size]
+        self.matrix, self.ids = matrix, ids
+
+    def put_many(self, rows):
+        for row in rows:
+            vector = np.array([getattr(row, field) for field in self.fields], dtype=np.float64)
+            position = self.positions.get(row.id)
+            if position is None:
+                self.grow(self.size + 1)
+                position = self.size
+                self.size += 1
+                self.positions[row.id] = position
+                self.ids[position] = row.id
+            else:
+                old = self.matrix[position]
+                self.sums -= old
+                self.squares -= old ** 2
+            self.matrix[position] = vector
+            self.sums += vector
+            self.squares += vector ** 2
+
+    def remove_many(self, ids):
+        for id in ids:
+            position = self.positions.pop(id, None)
+            if position is None:
+                continue
+            old = self.matrix[position]
+            self.sums -= old
+            self.squares -= old ** 2
+            # The last row takes the freed position
+            last = self.size - 1
+            if position != last:
+                self.matrix[position] = self.matrix[last]
+                self.ids[position] = self.ids[last]
+                self.positions[int(self.ids[last])] = position
+            self.size -= 1
+
+    def weights(self, fields):
+        # 1 / variance for the given fields, 0 for the others so they drop out of the distance
+        weights = np.zeros(len(self.fields))
+        columns = [self.fields.index(field) for field in fields]
+        if self.size < 2:
+            weights[columns] = 1.0
+            return weights
+        mean = self.sums[columns] / self.size
+        variance = np.maximum(self.squares[columns] / self.size - mean ** 2, 0.0)
+        # Constant columns do not separate anything, any weight works
+        variance[variance < 1e-12] = 1.0
+        weights[columns] = 1.0 / variance
+        return weights
+
+    def nearest(self, id, k=10, fields=NUTRITION_FIELDS):
+        """Return up to k (id, distance) pairs closest to id, or None when id is unknown."""
+        position = self.positions.get(id)
+        if position is None:
+            return None
+        weights = self.weights(fields)
+        query = self.matrix[position].copy()
+        candidates = []
+        # Batches keep the temporary arrays small on large catalogs
+        for start in range(0, self.size, self.batch_size):
+            stop = min(start + self.batch_size, self.size)
+            diff = self.matrix[start:stop] - query
+            distances = (diff * diff) @ weights
+            if start <= position < stop:
+                distances[position - start] = np.inf
+            count = min(k, stop - start)
+            top = np.argpartition(distances, count - 1)[:count] if count < stop - start else np.arange(stop - start)
+            candidates.extend(zip(distances[top].tolist(), self.ids[start:stop][top].tolist()))
+        best = heapq.nsmallest(k, ((distance, id) for distance, id in candidates if distance != np.inf))
+        return [(id, float(np.sqrt(distance))) for distance, id in best]
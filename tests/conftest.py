@@ -0,0 +1,42 @@
+import json
+import os
+import secrets
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from synthetic import seed_sqlite
+
+ROWS = 120
+ADMIN = {"username": "admin", "password": "admin"}
+
+def prepare_workdir(workdir, catalog_mode):
+    # main.py reads its settings and pictures relative to the working directory
+    url = seed_sqlite(os.path.join(workdir, 'cereals.db'), ROWS)
+    with open(os.path.join(workdir, 'db_info.json'), 'w') as f:
+        json.dump({"url": url, "connect_args": {}, "catalog_mode": catalog_mode, "startup_mode": "auto"}, f)
+    with open(os.path.join(workdir, 'jwt_info.json'), 'w') as f:
+        json.dump({"secret_key": secrets.token_hex(32), "algorithm": "HS256", "access_token_expire_minutes": 60}, f)
+    for name in ('Cereal Pictures', 'Cereal.csv'):
+        os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+
+@pytest.fixture(scope="module", params=["sql", "catalog"])
+def client(request, tmp_path_factory):
+    """The app on a fresh SQLite database of ROWS synthetic cereals, once per module and mode."""
+    from fastapi.testclient import TestClient
+    workdir = tmp_path_factory.mktemp(request.param)
+    prepare_workdir(str(workdir), request.param == "catalog")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(workdir)
+        import main
+        with TestClient(main.app) as client:
+            yield client
+
+@pytest.fixture(scope="module")
+def admin_headers(client):
+    response = client.post("/token", data=ADMIN)
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
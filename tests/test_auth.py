@@ -0,0 +1,25 @@
+from conftest import ADMIN
+
+def test_revoke_ignores_username_case(client):
+    token = client.post("/token", data=ADMIN).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get("/db/pool", headers=headers).status_code == 200
+    assert client.post("/users/Admin/revoke", headers=headers).status_code == 200
+    assert client.get("/db/pool", headers=headers).status_code == 401
+
+def test_duplicate_email_is_not_taken_for_a_duplicate_username(client):
+    user = {"username": "first", "email": "username@example.com", "password": "secret"}
+    assert client.post("/users/create", json=user).status_code == 200
+    response = client.post("/users/create", json={**user, "username": "second"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Email already exists"
+    response = client.post("/users/create", json={**user, "email": "other@example.com"})
+    assert response.json()["detail"] == "Username already exists"
+
+def test_violated_unique_key_reads_the_key_not_the_value():
+    from sqlalchemy.exc import IntegrityError
+    from db_classes import violated_unique_key
+    mysql = IntegrityError("INSERT", {}, Exception(1062, "Duplicate entry 'username@example.com' for key 'users.email'"))
+    assert violated_unique_key(mysql) == "email"
+    old_mysql = IntegrityError("INSERT", {}, Exception(1062, "Duplicate entry 'email' for key 'username'"))
+    assert violated_unique_key(old_mysql) == "username"
@@ -0,0 +1,20 @@
+def test_delete_batch_has_one_result_per_position(client, admin_headers):
+    response = client.request("DELETE", "/cereals/batch", json=[1, 1, 99999, 2], headers=admin_headers)
+    assert response.status_code == 200
+    assert [(item["index"], item["id"], item["status"]) for item in response.json()] == [
+        (0, 1, "deleted"),
+        (1, 1, "error"),
+        (2, 99999, "not_found"),
+        (3, 2, "deleted"),
+    ]
+    assert response.json()[1]["detail"] == "Duplicate item in batch"
+    assert client.get("/cereals/1").status_code == 404
+
+def test_upsert_batch_reports_name_collisions_per_item(client, admin_headers):
+    cereal = {key: value for key, value in client.get("/cereals/3").json().items() if key != 'id'}
+    taken = client.get("/cereals/5").json()["name"]
+    items = [{**cereal, "id": 3, "name": taken}, {**cereal, "id": 3, "rating": 12.5}, {**cereal, "name": "New Cereal"}, {**cereal, "name": "new cereal"}]
+    response = client.post("/cereals/batch", json=items, headers=admin_headers)
+    assert response.status_code == 200
+    assert [item["status"] for item in response.json()] == ["error", "updated", "created", "error"]
+    assert client.get("/cereals/3").json()["rating"] == 12.5
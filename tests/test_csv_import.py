@@ -0,0 +1,38 @@
+import io
+import os
+
+from csv_transfer import CerealCsvReader
+from conftest import ROOT
+
+class ReadOnlyFile:
+    # Like SpooledTemporaryFile on Python 3.10: read and readline, but no readable()
+    def __init__(self, data):
+        self.buffer = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.buffer.read(size)
+
+    def readline(self, size=-1):
+        return self.buffer.readline(size)
+
+def cereal_csv():
+    with open(os.path.join(ROOT, 'Cereal.csv'), 'rb') as f:
+        return f.read()
+
+def test_reader_needs_only_read():
+    data = b'\xef\xbb\xbf' + cereal_csv().replace(b'\n', b'\r\n')
+    reader = CerealCsvReader(ReadOnlyFile(data))
+    rows = reader.read_chunk(1000)
+    assert len(rows) == 77
+    assert [error for line, item, error in rows if error is not None] == []
+    assert rows[0][0] == 3 and rows[0][1]['name'] == '100% Bran'
+
+def test_import_reports_a_summary(client, admin_headers):
+    response = client.post("/cereals/import", files={"file": ("Cereal.csv", cereal_csv())}, headers=admin_headers)
+    assert response.status_code == 200, response.text
+    assert response.json() == {"created": 0, "updated": 77, "failed": 0, "errors": []}
+
+def test_import_rejects_other_encodings(client, admin_headers):
+    data = "name;mfr\nCaf\xe9;K\n".encode('latin-1')
+    response = client.post("/cereals/import", files={"file": ("latin1.csv", data)}, headers=admin_headers)
+    assert response.status_code == 400
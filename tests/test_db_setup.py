@@ -0,0 +1,39 @@
+import asyncio
+import os
+
+from conftest import ROOT
+from db_connect import DatabaseConnect
+from db_setup import DatabaseSetup
+
+def run_seed(tmp_path, csv_text):
+    path = tmp_path / 'Cereal.csv'
+    path.write_text(csv_text)
+
+    async def seed():
+        db = DatabaseConnect(f"sqlite+aiosqlite:///{tmp_path / 'seed.db'}", connect_args={})
+        setup = DatabaseSetup(db)
+        try:
+            await setup.migrate()
+            seeded = await setup.seed_cereals(str(path))
+            async with await db.get_new_session() as session:
+                checksum = await setup.get_meta(session, 'cereal_csv_sha256')
+            return seeded, checksum
+        finally:
+            await db.close()
+    return asyncio.run(seed())
+
+def test_failed_rows_keep_the_seed_pending(tmp_path, caplog):
+    with open(os.path.join(ROOT, 'Cereal.csv')) as f:
+        lines = f.read().splitlines()
+    # The first cereal twice, with a different rating
+    duplicate = lines[2].rsplit(';', 1)[0] + ';12'
+    seeded, checksum = run_seed(tmp_path, "\n".join(lines + [duplicate]) + "\n")
+    assert seeded is False
+    assert checksum is None
+    assert "100% Bran" in caplog.text and "Duplicate item in batch" in caplog.text
+
+def test_clean_file_stores_the_checksum(tmp_path):
+    with open(os.path.join(ROOT, 'Cereal.csv')) as f:
+        seeded, checksum = run_seed(tmp_path, f.read())
+    assert seeded is True
+    assert checksum is not None
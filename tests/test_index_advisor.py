@@ -0,0 +1,27 @@
+from db_classes import Cereal
+
+BAD_FILTERS = [
+    {"filters": {"calories": ["lt", {"a": 1}]}, "order": "asc"},
+    {"filters": {"write_version": ["gt", 1]}, "order": "asc"},
+    {"filters": {"calories": ["between", 1]}, "order": "asc"},
+]
+
+def test_failed_queries_are_not_recorded(client, admin_headers):
+    client.delete("/db/query-shapes", headers=admin_headers)
+    for body in BAD_FILTERS:
+        assert client.post("/cereals/filter", json=body).status_code >= 400
+    assert client.post("/cereals/filter", json={"filters": {"calories": ["lt", 100]}, "order": "asc"}).status_code == 200
+    shapes = client.get("/db/query-shapes", headers=admin_headers).json()
+    assert [shape["conditions"] for shape in shapes] == [[["calories", "lt"]]]
+    response = client.get("/db/index-advice", headers=admin_headers)
+    assert response.status_code == 200
+    assert [item["error"] for item in response.json()] == [None]
+
+def test_a_bad_sample_is_reported_with_its_shape(client, admin_headers):
+    client.delete("/db/query-shapes", headers=admin_headers)
+    Cereal.query_shapes.record(Cereal, [("calories", "lt", {"a": 1})], None, 'asc', 0.5, 'sql')
+    client.post("/cereals/filter", json={"filters": {"sugars": ["gt", 5]}, "order": "asc"})
+    advice = client.get("/db/index-advice", headers=admin_headers).json()
+    errors = {tuple(map(tuple, item["conditions"])): item["error"] for item in advice}
+    assert errors[(("calories", "lt"),)] is not None
+    assert errors[(("sugars", "gt"),)] is None
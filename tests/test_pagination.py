@@ -0,0 +1,57 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from pagination import encode_cursor, NDJSON_MEDIA_TYPE
+
+# (method, path, query, body) of every paginated list, in both directions, on id and on other columns
+LISTS = [
+    ("GET", "/cereals", {}, None),
+    ("GET", "/cereals/sorted/id", {"order": "asc"}, None),
+    ("GET", "/cereals/sorted/id", {"order": "desc"}, None),
+    ("GET", "/cereals/sorted/rating", {"order": "asc"}, None),
+    ("GET", "/cereals/sorted/rating", {"order": "desc"}, None),
+    ("GET", "/cereals/sorted/calories", {"order": "desc"}, None),
+    ("GET", "/cereals/id/10", {"comparison": "gt", "order": "desc"}, None),
+    ("GET", "/cereals/calories/100", {"comparison": "lte", "order": "asc"}, None),
+    ("GET", "/cereals/calories/100", {"comparison": "lte", "order": "desc"}, None),
+    ("POST", "/cereals/filter", {}, {"filters": {"id": ["gt", 10]}, "order": "desc"}),
+    ("POST", "/cereals/filter", {}, {"filters": {"cups": ["gt", 0.5]}, "order": "desc"}),
+    ("POST", "/cereals/filter", {}, {"filters": {"sugars": ["lt", 10]}, "order": "asc"}),
+]
+
+def read_ids(client, method, path, params, body, accept):
+    response = client.request(method, path, params=params, json=body, headers={"Accept": accept})
+    assert response.status_code == 200, (path, params, response.text)
+    if accept == NDJSON_MEDIA_TYPE:
+        rows = [json.loads(line) for line in response.text.splitlines()]
+    else:
+        rows = response.json()
+    return [row["id"] for row in rows], response.headers.get("X-Next-Cursor")
+
+@pytest.mark.parametrize("accept", ["application/json", NDJSON_MEDIA_TYPE])
+@pytest.mark.parametrize("method,path,params,body", LISTS)
+def test_pages_cover_the_list_once(client, method, path, params, body, accept):
+    expected, cursor = read_ids(client, method, path, params, body, accept)
+    assert cursor is None
+    count = len(expected)
+    # A page size that divides the list must not end with a cursor to a 404
+    limits = {count, 7} | ({count // 2} if count % 2 == 0 else set())
+    for limit in sorted(limits):
+        seen, cursor = [], None
+        while True:
+            page = {**params, "limit": limit, **({"cursor": cursor} if cursor else {})}
+            ids, cursor = read_ids(client, method, path, page, body, accept)
+            assert ids, (path, limit, seen)
+            seen += ids
+            if cursor is None:
+                break
+        assert seen == expected, (path, limit)
+
+def test_cursor_past_the_last_row_is_an_empty_page(client):
+    cursor = encode_cursor('id', 'asc', SimpleNamespace(id=10 ** 6))
+    response = client.get("/cereals", params={"limit": 10, "cursor": cursor})
+    assert response.status_code == 200
+    assert response.json() == []
+    assert "X-Next-Cursor" not in response.headers
@@ -0,0 +1,21 @@
+import asyncio
+
+from werkzeug.security import generate_password_hash
+
+import password_hashing
+from password_hashing import PasswordHasher
+
+def test_configure_does_not_hash(monkeypatch):
+    calls = []
+    monkeypatch.setattr(password_hashing, "generate_password_hash", lambda *args: calls.append(args))
+    hasher = PasswordHasher("scrypt")
+    hasher.configure("pbkdf2:sha256", workers=1, max_queue=1)
+    assert calls == []
+    assert hasher.executor is None
+
+def test_shorthand_methods_do_not_need_a_rehash():
+    async def check(method):
+        hasher = PasswordHasher(method)
+        return await hasher.needs_rehash(generate_password_hash("secret", method)), await hasher.needs_rehash(generate_password_hash("secret", "pbkdf2:sha1:1000"))
+    for method in ("scrypt", "pbkdf2:sha256", "scrypt:32768:8:1"):
+        assert asyncio.run(check(method)) == (False, True)
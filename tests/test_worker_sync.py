@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from worker_sync import WorkerSync
+
+@pytest.fixture
+def sync(tmp_path):
+    sync = WorkerSync(str(tmp_path))
+    yield sync
+    sync.close()
+
+def write_marker(sync, master, *workers):
+    with open(sync.setup_marker_path, 'w') as f:
+        f.write(" ".join(str(pid) for pid in (master,) + workers))
+
+def test_first_process_leads(sync):
+    assert sync.join() == (True, False)
+    sync.mark_joined(True)
+    assert sync.read_marker() == (os.getppid(), [os.getpid()])
+
+def test_respawned_worker_with_running_siblings_does_not_lead(sync):
+    sibling = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        write_marker(sync, os.getppid(), sibling.pid)
+        assert sync.join() == (False, True)
+        sync.mark_joined(False)
+        assert sync.read_marker() == (os.getppid(), [sibling.pid, os.getpid()])
+    finally:
+        sibling.kill()
+        sibling.wait()
+
+def test_respawned_worker_without_running_siblings_leads(sync):
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    write_marker(sync, os.getppid(), finished.pid)
+    assert sync.join() == (True, True)
+
+def test_new_master_leads_a_new_deployment(sync):
+    write_marker(sync, os.getpid(), os.getppid())
+    assert sync.join() == (True, False)
@@ -0,0 +1,119 @@
+import os
+import mmap
+import struct
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no file locks, run a single worker there
+    fcntl = None
+
+COUNTER_FORMAT = 'Q'
+
+def pid_alive(pid):
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows, where only one worker runs anyway
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+@contextmanager
+def file_lock(path):
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class SharedCounter:
+    """A version number in a memory mapped file, shared by every worker on the host."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'a+b') as f:
+            if os.fstat(f.fileno()).st_size < struct.calcsize(COUNTER_FORMAT):
+                f.write(b'\0' * struct.calcsize(COUNTER_FORMAT))
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), struct.calcsize(COUNTER_FORMAT))
+
+    def read(self):
+        return struct.unpack_from(COUNTER_FORMAT, self.map, 0)[0]
+
+    def increment(self):
+        with file_lock(f"{self.path}.lock"):
+            value = self.read() + 1
+            struct.pack_into(COUNTER_FORMAT, self.map, 0, value)
+        return value
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class WorkerSync:
+    """Coordinates the worker processes of one deployment through files in a shared directory.
+
+    Startup work runs under a lock, and is skipped by workers that join a deployment whose
+    workers are already running. Writes bump a shared counter, workers that see it change reload
+    their in-process copies of the data.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.startup_lock_path = os.path.join(directory, 'startup.lock')
+        self.setup_marker_path = os.path.join(directory, 'setup.done')
+        self.counter = SharedCounter(os.path.join(directory, 'changes'))
+        self.seen = self.counter.read()
+
+    def startup_lock(self):
+        return file_lock(self.startup_lock_path)
+
+    def read_marker(self):
+        # "<master pid> <worker pid> ...", written by the workers that started under that master
+        try:
+            with open(self.setup_marker_path) as f:
+                master, *workers = (int(pid) for pid in f.read().split())
+            return master, workers
+        except (FileNotFoundError, ValueError):
+            return None, []
+
+    def join(self):
+        """Returns (leader, respawned) for this process, call it under startup_lock.
+
+        A process started by the same master as the recorded workers was respawned, e.g. by
+        gunicorn after a crash. It only leads, and runs the setup, when none of those workers
+        is still running. A process of a new master leads a new deployment.
+        """
+        master, workers = self.read_marker()
+        respawned = master == os.getppid()
+        running = any(pid_alive(pid) for pid in workers if pid != os.getpid())
+        return not (respawned and running), respawned
+
+    def mark_joined(self, leader):
+        # The leader starts a new list once its setup is done, the others add themselves to it
+        if leader:
+            with open(self.setup_marker_path, 'w') as f:
+                f.write(f"{os.getppid()} {os.getpid()}")
+        else:
+            with open(self.setup_marker_path, 'a') as f:
+                f.write(f" {os.getpid()}")
+
+    def notify(self):
+        # Our own write needs no reload, unless another worker wrote in between
+        value = self.counter.increment()
+        if value == self.seen + 1:
+            self.seen = value
+
+    def changed(self):
+        return self.counter.read() != self.seen
+
+    def close(self):
+        self.counter.close()